@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Created Time : 2026-10-18 17:50:00
+Description  : Benchmarks of parsing and lookups, with saved baselines
+
+Usage:
+    python bench.py                         # run and print
+    python bench.py --save before           # also save as baselines/before.json
+    python bench.py --compare before        # compare with baselines/before.json
+    python bench.py --filter parse --quick
+"""
+
+import os,sys,json,time,shutil,tempfile,argparse,platform,tracemalloc,threading,itertools
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import ini
+from ini import Ini
+from gen_config import generate
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),'baselines')
+
+# name: arguments of gen_config.generate
+SCENARIOS = { 'mixed'   : dict(headers=60,keys=30,depth=2,width=3,vec_len=200,chain=50,env=20,cmds=10),
+              'wide'    : dict(headers=500,keys=40,depth=0,width=0,vec_len=0,chain=0,env=0,cmds=0),
+              'deep'    : dict(headers=130,keys=10,depth=6,width=2,vec_len=0,chain=0,env=0,cmds=0),
+              'vectors' : dict(headers=20,keys=4,depth=1,width=2,vec_len=20000,vec_per_line=50,chain=0,env=0,cmds=0),
+              'refs'    : dict(headers=1,keys=6,depth=0,width=0,vec_len=0,chain=3000,env=0,cmds=0),
+              'env'     : dict(headers=1,keys=6,depth=0,width=0,vec_len=0,chain=0,env=3000,cmds=0),
+              'cmds'    : dict(headers=1,keys=6,depth=0,width=0,vec_len=0,chain=20,env=0,cmds=40),
+             }
+
+# name: (accessor, field, kwargs), all on the 'mixed' scenario
+LOOKUPS = { 'find'          : ('find','H3~Str3',{}),
+            'findInt'       : ('findInt','H3~Int0',{}),
+            'findNum'       : ('findNum','H3~Num1',{}),
+            'findBool'      : ('findBool','H3~Bool2',{}),
+            'findStringVec' : ('findStringVec','H3~List5',{}),
+            'findNumVec'    : ('findNumVec','H3~Vec',{}),
+            'findIntVec'    : ('findIntVec','H3~Vec',{}),
+            'findArray'     : ('findArray','H3~Vec',{}),
+            'findArray_f32' : ('findArray','H3~Vec',{'dtype':'float32'}),
+            'findArray_str' : ('findArray','H3~List5',{'dtype':'str'}),
+            'find_kwargs'   : ('find','Replace',{'dt':20220101,'name':'px'}),
+            'get_default'   : ('get','H3~Undefined',{}),
+            'exists'        : ('exists','H3~Ref4',{}),
+           }
+
+def best(fn,repeat,number=1):
+    '''
+    Best time of *repeat* runs of *number* calls, per call.
+    '''
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter()-t)/number)
+    return min(times)
+
+def peak(fn):
+    '''
+    Peak of the memory allocated by Python during *fn*.
+    '''
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def per_instance(fn,n=20):
+    '''
+    Memory allocated by Python and kept by each of *n* objects made by *fn*.
+    '''
+    fn()
+    tracemalloc.start()
+    try:
+        objs = [fn() for _ in range(n)]
+        return tracemalloc.get_traced_memory()[0]/len(objs)
+    finally:
+        tracemalloc.stop()
+
+def contention(o,readers,writer=None,duration=1.0):
+    '''
+    Time per lookup of *readers* threads reading *o* for *duration* seconds, while
+    *writer* is called in a loop in another thread if given.
+    '''
+    stop = threading.Event()
+    counts = [0]*readers
+    def read(i):
+        n = 0
+        while not stop.is_set():
+            o.findInt('H3~Int0'); o.exists('H3~Flag'); o.findNumVec('H3~Vec')
+            n += 3
+        counts[i] = n
+    def write():
+        while not stop.is_set():
+            writer()
+    threads = [threading.Thread(target=read,args=(i,)) for i in range(readers)]
+    if writer is not None:
+        threads.append(threading.Thread(target=write))
+    for t in threads:
+        t.start()
+    time.sleep(duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    return duration/sum(counts)
+
+def with_env(environ,fn):
+    old = {k:os.environ.get(k) for k in environ}
+    os.environ.update(environ)
+    try:
+        return fn()
+    finally:
+        for k,v in old.items():
+            if v is None:
+                os.environ.pop(k,None)
+            else:
+                os.environ[k] = v
+
+def run(tmp,quick=False,only=None):
+    '''
+    Run the benchmarks, return ``{name: [value, unit]}``.
+    '''
+    repeat = 3 if quick else 7
+    number = 2000 if quick else 20000
+    out = {}
+    def want(name):
+        return only is None or any(s in name for s in only)
+    for name,kwargs in SCENARIOS.items():
+        fini,environ = generate(os.path.join(tmp,name),**kwargs)
+        for lazy in [False,True]:
+            key = 'parse{}:{}'.format('_lazy'*lazy,name)
+            if not want(key):
+                continue
+            parse = lambda: Ini(fini,lazy=lazy)
+            out[key] = [with_env(environ,lambda: best(parse,repeat)),'s']
+            out[key.replace('parse','peak',1)] = [with_env(environ,lambda: peak(parse)),'B']
+    fini,environ = generate(os.path.join(tmp,'mixed'),**SCENARIOS['mixed'])
+    for memo in [1024,0]:
+        o = with_env(environ,lambda: Ini(fini,memo_size=memo))
+        for name,(method,field,kwargs) in LOOKUPS.items():
+            key = 'lookup{}:{}'.format('_nomemo'*(not memo),name)
+            if want(key):
+                fn = getattr(o,method)
+                out[key] = [best(lambda: fn(field,**kwargs),repeat,number),'s']
+    for keep in [False,True]:
+        key = 'memory{}:mixed'.format('_source'*keep)
+        if want(key):
+            out[key] = [with_env(environ,lambda: per_instance(lambda: Ini(fini,keep_source=keep))),'B']
+    if want('load_many'):
+        common,environ = generate(os.path.join(tmp,'common'),**SCENARIOS['mixed'])
+        finis = []
+        for i in range(50):
+            finis.append(os.path.join(tmp,'strategy{}.ini'.format(i)))
+            with open(finis[-1],'w') as f:
+                f.write('include <{}>\n[]\nId = {}\n'.format(os.path.relpath(common,tmp),i))
+        out['load_many:separate'] = [with_env(environ,lambda: best(lambda: [Ini(f) for f in finis],repeat)),'s']
+        out['load_many:threads'] = [with_env(environ,lambda: best(lambda: Ini.load_many(finis),repeat)),'s']
+    if want('contention'):
+    # 读者线程的吞吐，写者每毫秒改一次：单个键、一批键、或重新解析
+        o = with_env(environ,lambda: Ini(fini))
+        n = itertools.count()
+        writers = {'read'        : None,
+                   'read_set'    : lambda: (o.set('H3~Flag',next(n)),time.sleep(1e-3)),
+                   'read_update' : lambda: (o.update({'H{}~Flag'.format(h):next(n) for h in range(10)}),time.sleep(1e-3)),
+                   'read_reload' : lambda: (with_env(environ,lambda: o.reload(force=True)),time.sleep(1e-3)),
+                  }
+        for name,writer in writers.items():
+            out['contention:'+name] = [contention(o,4,writer,0.3 if quick else 1.0),'s']
+    if want('snapshot'):
+        o = with_env(environ,lambda: Ini(fini))
+        path = os.path.join(tmp,'mixed.map')
+        out['snapshot:export'] = [best(lambda: o.export(path),repeat),'s']
+        out['snapshot:open'] = [best(lambda: ini.IniMap(path),repeat,100),'s']
+        m = ini.IniMap(path)
+        out['snapshot:findNumVec'] = [best(lambda: m.findNumVec('H3~Vec'),repeat,number),'s']
+    return out
+
+def fmt(v,unit):
+    if unit == 'B':
+        return '{:.1f} MB'.format(v/2**20) if v >= 2**20 else '{:.0f} KB'.format(v/2**10)
+    for scale,u in [(1,'s'),(1e-3,'ms'),(1e-6,'us')]:
+        if v >= scale:
+            return '{:.3g} {}'.format(v/scale,u)
+    return '{:.3g} ns'.format(v/1e-9)
+
+def report(results,baseline=None,threshold=0.2):
+    '''
+    Print the results, with the ratio to *baseline* if given. Return the names that got
+    slower or bigger by more than *threshold*.
+    '''
+    worse = []
+    width = max(len(k) for k in results)
+    for k,(v,unit) in results.items():
+        line = '{:<{}}  {:>10}'.format(k,width,fmt(v,unit))
+        if baseline is not None and k in baseline['results']:
+            b = baseline['results'][k][0]
+            ratio = v/b if b else float('inf')
+            flag = ''
+            if ratio > 1+threshold:
+                flag = '  << slower' if unit == 's' else '  << bigger'
+                worse.append(k)
+            elif ratio < 1-threshold:
+                flag = '  faster' if unit == 's' else '  smaller'
+            line += '  {:>10}  x{:.2f}{}'.format(fmt(b,unit),ratio,flag)
+        print(line)
+    if worse:
+        print('\n{} regression(s) over {:.0%}: {}'.format(len(worse),threshold,', '.join(worse)))
+    return worse
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the ini package.')
+    parser.add_argument('--save',metavar='NAME',help='save the results as baselines/NAME.json')
+    parser.add_argument('--compare',metavar='NAME',help='compare with baselines/NAME.json')
+    parser.add_argument('--threshold',type=float,default=0.2,help='relative change reported as a regression')
+    parser.add_argument('--filter',nargs='*',help='only run the benchmarks whose name contains one of these')
+    parser.add_argument('--quick',action='store_true',help='fewer repeats')
+    args = parser.parse_args()
+    baseline = None
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR,args.compare+'.json')) as f:
+            baseline = json.load(f)
+    tmp = tempfile.mkdtemp(prefix='ini-bench-')
+    try:
+        results = run(tmp,args.quick,args.filter)
+    finally:
+        shutil.rmtree(tmp,ignore_errors=True)
+    print('ini: {}\npython {} on {}\n'.format(ini.__file__,platform.python_version(),platform.platform()))
+    worse = report(results,baseline,args.threshold)
+    if args.save:
+        os.makedirs(BASELINE_DIR,exist_ok=True)
+        with open(os.path.join(BASELINE_DIR,args.save+'.json'),'w') as f:
+            json.dump({'python':platform.python_version(),'platform':platform.platform(),
+                       'time':time.strftime('%Y-%m-%d %H:%M:%S'),'results':results},f,indent=1)
+    return 1 if worse else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
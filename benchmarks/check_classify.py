@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Created Time : 2026-10-18 19:10:00
+Description  : Differential check of ini.classify_line against the ordered PATT loop
+
+Usage:
+    python check_classify.py                    # example configs, generated tree, random lines
+    python check_classify.py --n 1000000 --seed 7
+"""
+
+import os,re,sys,glob,random,argparse,tempfile,shutil
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+import ini
+from gen_config import generate
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+
+# 随机行的片段，偏向语法字符
+PIECES = ['include','include?',' <','<','>','.ini','[',']','=','|=','$=',' ','  ','\t','a','Key','_','.',
+          '1','2.5','%','%Ref%','$','$(echo x)','(',')','?','*','~','-','/','é','　']
+# 半数随机行按 开头 + 赋值符号 + 片段 + 结尾 拼出，覆盖每种行
+STARTS = ['include','include?','includes','Key','a.b_1','[','',' ','\t']
+OPS = ['',' ','=',' = ','|=',' |= ','$=',' $= ','=[','= [','|= [','$=[',' <','\t<']
+ENDS = ['','.ini>','.ini> ','>',']',' ]','] ','[']
+
+def reference(s):
+    '''
+    The original classifier: the first pattern of ``PATT``, in order, that matches.
+    '''
+    for key,pat in ini.PATT.items():
+        content = re.findall(pat,s)
+        if content:
+            return key,content
+    return None,None
+
+def config_lines(tmp):
+    '''
+    Lines of the example configs and of a generated tree of every benchmark shape.
+    '''
+    files = glob.glob(os.path.join(ROOT,'examples','**','*.ini'),recursive=True)
+    fini,_ = generate(os.path.join(tmp,'gen'),headers=30,keys=12,depth=2,width=2,vec_len=60,
+                      vec_per_line=7,chain=20,env=10,cmds=6)
+    files += glob.glob(os.path.join(os.path.dirname(fini),'**','*.ini'),recursive=True)
+    for f in files:
+        with open(f,encoding='utf-8',errors='replace') as fh:
+            for l in fh.read().split('\n'):
+                yield l
+
+def random_lines(n,seed):
+    rnd = random.Random(seed)
+    for _ in range(n):
+        mid = ''.join(rnd.choice(PIECES) for _ in range(rnd.randint(0,12)))
+        if rnd.random() < 0.5:
+            yield mid
+        else:
+            yield rnd.choice(STARTS)+rnd.choice(OPS)+mid+rnd.choice(ENDS)
+
+def check(lines):
+    '''
+    Lines, comment stripped as in :py:func:`ini.tokenize`, on which the two classifiers
+    differ, with both results.
+    '''
+    bad = []
+    for l in lines:
+        l = l.partition('#')[0]
+        a,b = ini.classify_line(l),reference(l)
+        if a!=b:
+            bad.append((l,a,b))
+    return bad
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare ini.classify_line with the PATT loop.')
+    parser.add_argument('--n',type=int,default=200000,help='number of random lines')
+    parser.add_argument('--seed',type=int,default=0)
+    args = parser.parse_args()
+    tmp = tempfile.mkdtemp(prefix='ini-classify-')
+    try:
+        lines = list(config_lines(tmp))
+    finally:
+        shutil.rmtree(tmp,ignore_errors=True)
+    bad = check(lines)+check(random_lines(args.n,args.seed))
+    for l,a,b in bad[:20]:
+        print('{!r}\n    classify_line: {}\n    PATT loop    : {}'.format(l,a,b))
+    print('{} config lines, {} random lines, {} mismatch(es)'.format(len(lines),args.n,len(bad)))
+    return 1 if bad else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Created Time : 2026-10-18 17:40:00
+Description  : Generator of synthetic ini trees for the benchmarks
+"""
+
+import os
+import argparse
+
+def vector(n,per_line,start=0):
+    '''
+    Lines of a multi-line ``[...]`` vector of *n* numbers, *per_line* on each line.
+    '''
+    nums = ['{:.4f}'.format((start+i)*0.37%97) for i in range(n)]
+    rows = [' '.join(nums[i:i+per_line]) for i in range(0,n,per_line)] or ['']
+    if len(rows) == 1:
+        return ['[ {} ]'.format(rows[0])]
+    return ['[ '+rows[0]]+['    '+r for r in rows[1:-1]]+['    '+rows[-1]+' ]']
+
+def section(name,keys,vec_len,vec_per_line,seed):
+    '''
+    Lines of one header with *keys* scalars of every type, references to the top level
+    and to its own keys, and a long vector if *vec_len*.
+    '''
+    out = ['','[{}]'.format(name)]
+    for k in range(keys):
+        kind = k%6
+        if kind == 0:
+            out.append('Int{}       = {}'.format(k,seed*7+k))
+        elif kind == 1:
+            out.append('Num{}       = {:.6f}'.format(k,(seed+k)/7))
+        elif kind == 2:
+            out.append('Bool{}      = {}'.format(k,'true' if (seed+k)%2 else 'F'))
+        elif kind == 3:
+            out.append('Str{}       = value_{}_{}'.format(k,seed,k))
+        elif kind == 4:
+            out.append('Ref{}       = %Root%/%Str{}%'.format(k,k-1))
+        else:
+            out.append('List{}      = [ a{} b{} c{} 1 2 3 ]'.format(k,k,seed,k))
+    if vec_len:
+        lines = vector(vec_len,vec_per_line,seed)
+        out.append('Vec         = '+lines[0])
+        out += lines[1:]
+    return out
+
+def generate(root:str,headers:int=50,keys:int=40,depth:int=2,width:int=3,vec_len:int=200,
+             vec_per_line:int=20,chain:int=50,env:int=20,cmds:int=10):
+    '''
+    Write a tree of ini files under *root*.
+
+    Parameters
+    ----------
+    root : str
+        Output directory, created if needed.
+    headers : int
+        Headers over all files, each with *keys* keys and a *vec_len* vector.
+    depth, width : int
+        Every file includes *width* files one directory deeper, down to *depth* levels.
+    chain : int
+        Length of the chain of ``%ref%`` at the top level.
+    env : int
+        Number of ``|=`` keys; half of them get a value from the environment.
+    cmds : int
+        Number of stub ``$(...)`` commands, a third of them taking a ``%ref%``.
+
+    Returns
+    -------
+    fini : str
+        Top-level ini file.
+    environ : dict
+        Environment variables to set before parsing.
+    '''
+    files = [('main.ini',0)]
+    tree = {}
+    i = 0
+    while i < len(files):
+        name,level = files[i]
+        tree[name] = []
+        if level < depth:
+            base = os.path.splitext(name)[0]
+            for w in range(width):
+                child = '{}_{}/f.ini'.format(base,w) if level == 0 else '{}/d{}/f.ini'.format(os.path.dirname(name),w)
+                tree[name].append(child)
+                files.append((child,level+1))
+        i += 1
+    per_file = [headers//len(files)+(j < headers%len(files)) for j in range(len(files))]
+# 顶层：基础键、引用链、环境变量覆盖和命令
+    top = ['[]','Root        = /data/bench','Today       = %TODAY%','Replace     = %Root%/$dt$/$name$.csv']
+    top += ['Chain0      = c0']+['Chain{}      = %Chain{}%_c{}'.format(c,c-1,c) for c in range(1,chain)]
+    environ = {}
+    for e in range(env):
+        top.append('Env{}       |= default_{}'.format(e,e))
+        if e%2 == 0:
+            environ['ENV{}'.format(e)] = 'from_env_{}'.format(e)
+    for c in range(cmds):
+        if c%3 == 2:
+            top.append('Cmd{}       = $(echo %Root%/stub{})'.format(c,c))
+        else:
+            top.append('Cmd{}       = $(echo stub{})'.format(c,c))
+    seed = 0
+    for j,(name,_) in enumerate(files):
+        lines = top if j == 0 else ['[]']
+        for h in range(per_file[j]):
+            lines += section('H{}'.format(seed),keys,vec_len,vec_per_line,seed)
+            seed += 1
+        for child in tree[name]:
+            lines += ['','include <{}>'.format(os.path.relpath(child,os.path.dirname(name) or '.'))]
+        path = os.path.join(root,name)
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+        with open(path,'w') as f:
+            f.write('\n'.join(lines)+'\n')
+    return os.path.join(root,'main.ini'),environ
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic ini tree.')
+    parser.add_argument('root')
+    for k,v in [('headers',50),('keys',40),('depth',2),('width',3),('vec_len',200),
+                ('vec_per_line',20),('chain',50),('env',20),('cmds',10)]:
+        parser.add_argument('--'+k.replace('_','-'),type=int,default=v)
+    args = vars(parser.parse_args())
+    fini,environ = generate(**args)
+    print(fini)
+    for k,v in environ.items():
+        print('export {}={}'.format(k,v))
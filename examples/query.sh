@@ -0,0 +1,19 @@
+#! /bin/bash
+# Author       : lixiang @ firebolt
+# Created Time : 2026-10-18 18:30:00
+# Description  : Reading ini values from a shell script, with or without the query daemon
+
+INI="python ../ini.py"       # python -c 'import sys,ini; sys.exit(ini.main())' with the compiled module
+export INI_SOCKET=/tmp/ini-example.sock
+
+# Without the daemon every call parses main.ini
+eval "$($INI get main.ini String Int 'StringList[]')" || exit 1
+echo "$STRING $INT ${STRINGLIST[2]}"
+
+# With the daemon the parse is kept in memory until a file changes
+$INI serve &
+sleep 1
+eval "$($INI get --prefix CFG_ main.ini Referenced3 'NestedList[]')" || exit 1
+echo "$CFG_REFERENCED3 ${#CFG_NESTEDLIST[@]}"
+$INI diff main.ini
+$INI stop
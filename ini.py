@@ -3,20 +3,47 @@
 Configuration tool for xquant platform.
 """
 
-__all__ = [ 'Ini' ]
+__all__ = [ 'Ini','IniMap','Section','StringArray','IniDiff','Change','CommandRunner','IniServer','INIFormatError','INICommandError','INIRefError','INITemplateError','INIExtractError' ]
 
 #%% Import Part
-import os,re,copy,time
-import numpy as np
+import os,re,sys,stat,time,fnmatch,functools,importlib
+import io,json,hashlib,pickle,mmap,struct,zlib,bisect
+import signal,threading,fcntl,socket,shlex,argparse,contextlib
 import datetime as dm
 import subprocess
+from collections import OrderedDict
+from collections.abc import Mapping,MutableMapping,Sequence
+from types import MappingProxyType
+from concurrent.futures import Future,ThreadPoolExecutor,ProcessPoolExecutor,CancelledError,TimeoutError as FutureTimeoutError
 from typing import Union,Any
 
+class LazyModule():
+    '''
+    Module imported on first use, then put in place of this object, so that the command
+    line client does not pay for importing numpy and asyncio.
+    '''
+    def __init__(self,name:str,alias:str):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self,k):
+        mod = importlib.import_module(self._name)
+        globals()[self._alias] = mod
+        return getattr(mod,k)
+
+np = LazyModule('numpy','np')
+asyncio = LazyModule('asyncio','asyncio')
+
 #%% Patterns
 pRef = r'\%([^\%\s]+)\%'
 pCmd = r'\$\((.+)\)'
 pRep = r'\$(\w+)\$'
+CACHE_VERSION = 5
+MAP_MAGIC = b'INIMAP\0\1'
+BUILTIN_KEYS = ['PATH_FINI','CUR_DIR','TODAY','DATE']
+ARRAY_DTYPES = ['int32','int64','float32','float64','bool','str']
 PATT = { 'include'          : r'^include\s+<(.*ini)>\s*$',
+         'include_opt'      : r'^include\?\s+<(.*ini)>\s*$',
          'empty'            : r'^\s*$',
          'header'           : r'^\[(.*)\]\s*$',
          'scala'            : r'^([\w\.]+)\s*\=\s*([^\[\]]+)\s*$',
@@ -31,13 +58,37 @@ PATT = { 'include'          : r'^include\s+<(.*ini)>\s*$',
          'vec_mid'          : r'\s*([^<>\[\]]+)\s*$',
          'vec_end'          : r'\s*([^\[]*)\]\s*$',
         }
+# 预编译，按行首字符 / 赋值符号分派，保持 PATT 的匹配顺序
+_PATT = {k:re.compile(v) for k,v in PATT.items()}
+_pGlob = re.compile(r'[\*\?\[]')
+_pRep = re.compile(pRep)
+_pWord = re.compile(r'\w+')
+_pRef,_pCmd,_pBlanks = re.compile(pRef),re.compile(pCmd),re.compile(r'\s+')
+_pOp = re.compile(r'^[\w\.]+\s*(\||\$)?\=')
+_pListFile = re.compile(r'<([^\s<>]+)>')   # [<path>]：恰好一个不含空白和尖括号的路径
+_TAIL = ('vec_mid','vec_end')
+_DISPATCH = { ''    : ('scala','vec','vec_start'),
+              '|'   : ('scala_env','vec_env','vec_start_env'),
+              '$'   : ('scala_last','vec_last','vec_start_last'),
+             }
 
 #%% Class of Ini
 class Ini():
     '''
     Configuration tool for xquant platform.
     '''
-    def __init__(self,fini:str):
+    __slots__ = ['fini','cache_dir','lazy','memo_size','include_path','include_retries','include_backoff',
+                 'keep_source','dtypes','env','d','header','_file_cache','_callbacks','_watcher','_nocache',
+                 '_cmd_deadline','_runner','_trace','_loop','_builtin','_src','_files','_env_used',
+                 '_cmd_out','_field','_tree','_reuse','_stat','_real','_context','_memo','_stack',
+                 '_last','_digest','_lock','__weakref__']
+
+    def __init__(self,fini:str,cache_dir:str=None,
+                 cmd_workers:int=8,cmd_timeout:float=None,cmd_deadline:float=None,
+                 cmd_cache_dir:str=None,cmd_ttl:Union[float,dict]=60,cmd_nocache:list=(),
+                 lazy:bool=False,memo_size:int=1024,trace:bool=False,
+                 include_path:list=(),include_retries:int=0,include_backoff:float=0.1,
+                 file_cache:'FileCache'=None,keep_source:bool=False,dtypes:dict=None):
         '''
         Initialize Ini object.
 
@@ -45,199 +96,715 @@ class Ini():
         ----------
         fini : str
             Path of the entrance configuration file.
+        cache_dir : str, optional (default=None)
+            Directory of the parse cache. If given, the parsed result is saved there and
+            later ``Ini(fini)`` calls load it in one read as long as the included files,
+            the environment variables and the ``$(...)`` outputs it depends on are unchanged.
+            A stale or corrupt cache falls back to a full parse.
+        cmd_workers : int, optional (default=8)
+            Number of ``$(...)`` commands run at the same time. Commands without ``%..%``
+            references are started as soon as their file is read, and each distinct
+            command is run only once per parse.
+        cmd_timeout : float, optional (default=None)
+            Timeout in seconds of each command.
+        cmd_deadline : float, optional (default=None)
+            Deadline in seconds, from the start of parsing, for all commands together.
+        cmd_cache_dir : str, optional (default=None)
+            Directory of the command result cache. If given, the output of each command is
+            kept there, keyed by the command and the working directory, and reused by
+            every process until it expires. Processes asking for the same expired command
+            at the same time run it only once.
+        cmd_ttl : float or dict, optional (default=60)
+            Time to live in seconds of cached outputs, or a dict of ``{command: ttl}`` whose
+            ``'*'`` entry is the default. A ttl of 0 disables the cache for that command.
+        cmd_nocache : list, optional
+            Fields whose commands always run and bypass the cache.
+        lazy : bool, optional (default=False)
+            If True, values are kept raw and only resolved, once, when first read, so that
+            loading costs grow with the keys used instead of the keys defined. Results are
+            the same as the eager ones. Commands are then run on access, and *cmd_deadline*
+            only covers the parse.
+        memo_size : int, optional (default=1024)
+            Number of typed results of ``find*``/``get*`` kept per object, least recently
+            used first out. Arrays in it are read-only, lists are copied on return, and
+            :py:meth:`set <Ini.set>` drops the entries of its field. 0 disables it.
+        trace : bool, optional (default=False)
+            If True, record timed spans of the parse (files read, includes, commands,
+            resolution), see :py:meth:`stats <Ini.stats>` and
+            :py:meth:`export_trace <Ini.export_trace>`.
+        include_path : list, optional
+            Directories searched, in order, for a relative ``include <...>`` that is not
+            found next to the including file.
+        include_retries : int, optional (default=0)
+            Times a missing ``include <...>`` is looked up again before it is skipped with
+            a warning, for network filesystems. ``include? <...>`` is optional and skipped
+            silently without retries.
+        include_backoff : float, optional (default=0.1)
+            Seconds before the first retry, doubled for each next one.
+        file_cache : FileCache, optional (default=None)
+            Cache of the files read and tokenized, shared with other Ini objects, see
+            :py:meth:`load_many <Ini.load_many>`.
+        keep_source : bool, optional (default=False)
+            If True, keep the lines of the parsed files in memory. Otherwise they are
+            kept compressed after the parse, and unpacked when
+            :py:attr:`context <Ini.context>` or :py:attr:`lines <Ini.lines>` is asked for
+            and by :py:meth:`reload <Ini.reload>`, which still does not read the unchanged
+            files again. An object of the 'mixed' benchmark (about 2000 keys over 13 files)
+            takes about 0.45 MB with its source compressed and 0.7 MB with it, see
+            ``benchmarks/bench.py --filter memory``.
+        dtypes : dict, optional (default=None)
+            Dtype of the arrays of vector fields, ``{field or shell-style pattern: dtype}``,
+            used by :py:meth:`findArray <Ini.findArray>` without a dtype, and by
+            :py:meth:`findNumVec <Ini.findNumVec>` / :py:meth:`findIntVec <Ini.findIntVec>`
+            for float / integer dtypes. See ``ARRAY_DTYPES``.
 
         Attributes
         -----------------
         context : str
-            Full contents of Ini object.
+            Full contents of Ini object, kept once asked for.
         keys : list
             All of the keys of Ini object.
         '''
         self.fini = fini
         #self.fini = fini.replace('~',os.environ['HOME'])  # Unrecognizable in condor
+        self.cache_dir = cache_dir
+        self.lazy = lazy
+        self.memo_size = memo_size
+        self.include_path = [os.path.abspath(d) for d in include_path]
+        self.include_retries = include_retries
+        self.include_backoff = include_backoff
+        self._file_cache = file_cache
+        self.keep_source = keep_source
+        self.dtypes = {k.upper():array_dtype(v) for k,v in (dtypes or {}).items()}
+        self._callbacks = []    # called with the changed keys after a reload
+        self._watcher = None    # stop event of the watch thread
+        self._lock = threading.RLock()  # serializes set, update and reload
     # Init global dict
         self._init()
     # Parse
-        self._parse_fini()
+        self._nocache = {f.upper() for f in cmd_nocache}
+        self._cmd_deadline = cmd_deadline
+        loop = getattr(self,'_loop',None)    # set by aload
+        if loop is None:
+            self._runner = CommandRunner(cmd_workers,cmd_timeout,cmd_deadline,cmd_cache_dir,cmd_ttl)
+        else:
+            self._runner = AsyncCommandRunner(cmd_workers,cmd_timeout,cmd_deadline,cmd_cache_dir,cmd_ttl,loop=loop)
+        self._runner.trace = self._trace = Tracer() if trace else None
+        if trace:
+            self._trace.begin('Ini','ini',file=os.path.abspath(fini),lazy=lazy)
+        try:
+            hit = cache_dir is not None and self._load_cache()
+            if not hit:
+                self._parse_fini()
+            self._done()
+            if cache_dir is not None and not hit:
+                self._save_cache()
+        finally:
+            self._runner.close()
+            self._runner.deadline = None
+            if trace:
+                self._trace.end()
+
+    @classmethod
+    async def aload(cls,fini:str,**kwargs):
+        '''
+        Asynchronous version of ``Ini(fini, **kwargs)``, giving the same object.
+
+        Files are read and parsed in the default executor of the running loop, and
+        ``$(...)`` commands run as asyncio subprocesses on that loop, so that it is never
+        blocked. Later commands (lazy mode, :py:meth:`reload <Ini.reload>`) run as usual.
+
+        Parameters
+        ----------
+        fini : str
+            Path of the entrance configuration file.
+        **kwargs
+            Arguments of :py:class:`Ini`.
+        '''
+        loop = asyncio.get_running_loop()
+        self = cls.__new__(cls)
+        self._loop = loop
+        try:
+            await loop.run_in_executor(None,functools.partial(self.__init__,fini,**kwargs))
+        finally:
+            del self._loop
+        if isinstance(getattr(self,'_runner',None),AsyncCommandRunner):
+            self._runner.loop = None
+        return self
+
+    @classmethod
+    async def aload_many(cls,finis:list,limit:int=8,**kwargs) -> list:
+        '''
+        Load many configuration files at the same time with :py:meth:`aload <Ini.aload>`.
+
+        Parameters
+        ----------
+        finis : list
+            Paths of the entrance configuration files.
+        limit : int, optional (default=8)
+            Maximum number of files loaded at the same time.
+        **kwargs
+            Arguments of :py:class:`Ini`, the same for every file.
+
+        Returns
+        -------
+        val : list
+            Ini objects, in the order of *finis*.
+        '''
+        sem = asyncio.Semaphore(limit)
+        async def load(fini):
+            async with sem:
+                return await cls.aload(fini,**kwargs)
+        return await asyncio.gather(*[load(f) for f in finis])
+
+    @classmethod
+    def load_many(cls,finis:list,workers:int=8,processes:bool=False,**kwargs) -> list:
+        '''
+        Load many configuration files, reading and tokenizing each distinct included file
+        only once. Results are the same as ``[Ini(fini, **kwargs) for fini in finis]``.
+
+        Parameters
+        ----------
+        finis : list
+            Paths of the entrance configuration files.
+        workers : int, optional (default=8)
+            Number of threads, or of processes if *processes*.
+        processes : bool, optional (default=False)
+            If True, parse in a process pool, each process with its own file cache, and
+            send the objects back pickled.
+        **kwargs
+            Arguments of :py:class:`Ini`, the same for every file. A *file_cache* given
+            here is used and filled by the threads.
+
+        Returns
+        -------
+        val : list
+            Ini objects, in the order of *finis*.
+        '''
+        if processes:
+            n = len(finis)
+            with ProcessPoolExecutor(workers) as pool:
+                return list(pool.map(load_shared,[cls]*n,finis,[kwargs]*n,
+                                     chunksize=max(1,n//(4*workers))))
+        cache = kwargs.pop('file_cache',None) or FileCache()
+        with ThreadPoolExecutor(workers) as pool:
+            return list(pool.map(lambda fini: cls(fini,file_cache=cache,**kwargs),finis))
 
     def _init(self):
     # Environment variables
         # 在命令行设定环境变量时，用'__'代替'~'
-        self.env = {k.upper().replace('__','~'):v for k,v in os.environ.items()}
-        self.d = copy.deepcopy(self.env)
+        self.env = environ()
+        self.d = Store(self.env)
     # Absolute path of top-level fini
         abs_path = os.path.abspath(self.fini)
-        self.d['PATH_FINI'] = abs_path
+        self.d.base['PATH_FINI'] = abs_path
     # Current dir of top-level fini
-        self.d['CUR_DIR'] = os.path.dirname(abs_path)
+        self.d.base['CUR_DIR'] = os.path.dirname(abs_path)
     # Today
         today_ = dm.datetime.today().strftime('%Y%m%d')
-        self.d['TODAY'] = today_
-        self.d['DATE'] = today_
+        self.d.base['TODAY'] = today_
+        self.d.base['DATE'] = today_
+    # Dependencies of the parse, for the parse cache
+        self._builtin = {k:self.d[k] for k in BUILTIN_KEYS}
+        self._src = {}          # field -> (file, line) where it is defined
+        self._files = {}        # file -> signature, None if missing
+        self._env_used = {}     # env key -> value read, None if absent
+        self._cmd_out = {}      # command -> output
+        self._field = None      # field being assigned
+        self._tree = None       # include tree, see _parse_fini
+        self._reuse = {}        # file -> (signature, lines, tokens) kept from the previous parse
+        self._trace = None      # Tracer if tracing
+        self._stat = {}         # path -> exists, for this parse
+        self._real = {}         # path -> realpath, for this parse
+        self._context = None
+        self._memo = OrderedDict()  # (field, converter, kwargs) -> typed value
+        self._digest = None     # (store, top, {(env, builtin): {header: (hash, fields)}}), see diff
+
+    def _done(self):
+    # 解析结束：丢掉只在解析时用的表，各文件的行和词法结果压缩起来留给 reload，保留源码时行另外留着
+        self._stat,self._real,self._stack,self._reuse = {},{},[],{}
+        pack_tree(self._tree,self.keep_source)
+    # 懒解析绑定到这次解析状态的副本上：reload 换掉本对象的状态后，拿着旧 Store 的读者仍按旧状态解析
+        if self.d.resolve is not None:
+            parse = type(self).__new__(type(self))
+            set_slots(parse,get_slots(self))
+            self.d.resolve = parse._resolve_key
 
     def _parse_fini(self):
-    # 栈
-        stack_dir = []
-        stack_fini = []
-        stack_ptr = []
-    # 读取原始文件内容
-        self.lines = file2list(self.fini)
-        push(self.fini,stack_dir,stack_fini,stack_ptr)
+    # 栈：每个文件一帧 [节点, 所在目录, 行指针, 各行的词法结果]，节点为 [文件, 行, {行号: (include 名, 子节点)}, 词法结果]
+        base = self.d.base
+        fini = os.path.abspath(self.fini)
+        tr = self._trace
+        if tr is not None:
+            tr.begin('file','file',file=fini,depth=0)
+        lines,toks = self._read_lines(fini)
+        self._tree = [fini,lines,{},toks]
+        stack = self._stack = [[self._tree,os.path.dirname(fini),0,toks]]
     # 逐行分析
-        ptr = 0
-        keys2rep = []
+        self._last = False
         self.header = None
-        while ptr < len(self.lines):
-            l = self.lines[ptr]
-        # 去注释
-            l,_,comments = l.partition('#') 
-            if not l:
-                if comments.startswith(' END include'):
-                    pop(stack_dir,stack_fini,stack_ptr)
-                ptr += 1
-                stack_ptr[-1] += 1
+        while stack:
+            frame = stack[-1]
+            node,dir_,ptr,toks = frame
+            if ptr >= len(toks):
+                stack.pop()
+                if tr is not None:
+                    tr.end(lines=ptr)
                 continue
-        # 识别正则表达式
-            type_,val = self._parse_pattern_type(l)
+            frame[2] = ptr+1
+        # 去注释后的行和识别结果，空行为 None
+            tok = toks[ptr]
+            if tok is None:
+                continue
+            l,type_,val = tok
         # 如果识别不了，报错
             if type_ is None:
-                raise INIFormatError('Cannot parse \'{}\' ( file: {}, line: {} ).'.format(l,stack_fini[-1],stack_ptr[-1]+1))
+                raise INIFormatError('Cannot parse \'{}\' ( file: {}, line: {} ).'.format(l,*self._location()))
         # include
-            elif type_ == 'include':
-                fini = self._true_value(val[0])
-            # 读新的 ini
-                fini_ = push(fini,stack_dir,stack_fini,stack_ptr)
-                if not os.path.exists(fini_):
-                    print('Warning: {} does not exists. Check 1st time.'.format(fini_))
-                    time.sleep(0.3)
-                if os.path.exists(fini_):
-                    lines = file2list(fini_)
-                # 将新的 ini 插入 self.lines 的 self.ptr 指向的位置，同时指针并不移动
-                    lines.insert(len(lines),'# END include <{}>'.format(fini))
-                    lines.insert(0,'# START include <{}>'.format(fini))
-                    self.lines[ptr:ptr+1] = lines
-                else:
-                    pop(stack_dir,stack_fini,stack_ptr)
-                    print('Warning: {} does not exists. Check 2nd time'.format(fini_))
-                ptr += 1
-        # 其它情况
-            else:
-            # empty
-                if type_ == 'empty':
-                    pass
-            # header
-                elif type_ == 'header':
-                    self.header = val[0].upper()
-            # assignment start
-                elif type_ in ['scala','scala_env','scala_last','vec','vec_start','vec_env','vec_start_env']:
-                # check header
-                    if self.header is None:
-                        raise INIFormatError('No header defined yet! ( file: {}, line: {} ).'.format(stack_fini[-1],stack_ptr[-1]+1))
-                    k,v = val[0]
-                    field = self._get_field(k)
-                # scala
-                    if type_ == 'scala':
-                        self.d[field] = rep_blanks(self._true_value(v))
-                    elif type_ == 'scala_env':
-                        # 先读环境变量，若没有环境变量再读文件中的值
-                        if field in self.env:
-                            self.d[field] = rep_blanks(self._true_value(self.env[field]))
-                        else:
-                            self.d[field] = rep_blanks(self._true_value(v))
-                    elif type_ == 'scala_last':
-                        # 放到最后才做 %xxx% 的替换
-                        self.d[field] = rep_blanks(v)
-                        keys2rep.append(field)
-                    elif type_ == 'vec':
-                        self.d[field] = rep_blanks(self._true_value(rep_blanks(v)))
-                    elif type_ == 'vec_env':
-                        # 先读环境变量，若没有环境变量再读文件中的值
-                        if field in self.env:
-                            self.d[field] = rep_blanks(self._true_value(rep_blanks(self.env[field])))
-                        else:
-                            self.d[field] = rep_blanks(self._true_value(rep_blanks(v)))
-                    elif type_ == 'vec_last':
-                        # 放到最后才做 %xxx% 的替换
-                        self.d[field] = rep_blanks(v)
-                        keys2rep.append(field)
-                    elif type_ == 'vec_start':
-                        value_str = rep_blanks(v)
-                        ignore_vec = False
-                    elif type_ == 'vec_start_env':
-                        # 先读环境变量，若没有环境变量再读文件中的值
-                        if field in self.env:
-                            value_str = rep_blanks(self.env[field])
-                            self.d[field] = rep_blanks(self._true_value(value_str))
-                            ignore_vec = True
-                        else:
-                            value_str = rep_blanks(v)
-                            ignore_vec = False
-                    elif type_ == 'vec_start_last':
-                        value_str = rep_blanks(v)
-                        ignore_vec = False
-                        keys2rep.append(field)
-                elif type_ in ['vec_mid','vec_end']:
-                    if ignore_vec: 
-                        ptr += 1
-                        stack_ptr[-1] += 1
-                        continue
+            elif type_ in ['include','include_opt']:
+                self._field = None
+                name = self._p1(self._value(val[0],False))
+            # 读新的 ini，压栈
+                fini_ = self._find_include(name,dir_,type_=='include_opt')
+                if fini_ is not None:
+                    real = self._realpath(fini_)
+                    if any(self._realpath(f[0][0])==real for f in stack):
+                        raise INIFormatError('Circular include of {} ( file: {}, line: {} ).'.format(fini_,*self._location()))
+                    if tr is not None:
+                        tr.begin('file','file',file=fini_,depth=len(stack))
+                    lines,toks = self._read_lines(fini_)
+                    child = [fini_,lines,{},toks]
+                    node[2][ptr] = (name,child)
+                    stack.append([child,os.path.dirname(os.path.abspath(fini_)),0,toks])
+                elif type_ == 'include':
+                    print('Warning: {} does not exist ( file: {}, line: {} ).'.format(name,*self._location()))
+        # empty
+            elif type_ == 'empty':
+                pass
+        # header
+            elif type_ == 'header':
+                self.header = val[0].upper()
+        # assignment start
+            elif type_ in ['scala','scala_env','scala_last','vec','vec_start','vec_env','vec_start_env']:
+            # check header
+                if self.header is None:
+                    raise INIFormatError('No header defined yet! ( file: {}, line: {} ).'.format(*self._location()))
+                k,v = val[0]
+                field = self._field = self._get_field(k)
+                self._src[field] = self._location()
+                if type_ in ['scala_env','vec_env','vec_start_env']:
+                    self._env_used[field] = self.env.get(field)
+            # scala
+                if type_ == 'scala':
+                    base[field] = self._value(v)
+                elif type_ == 'scala_env':
+                    # 先读环境变量，若没有环境变量再读文件中的值
+                    if field in self.env:
+                        base[field] = self._value(self.env[field])
                     else:
-                        if type_ == 'vec_mid':
-                            value_str = ' '.join([value_str, rep_blanks(val[0])])
-                        elif type_ == 'vec_end':
-                            value_str = ' '.join([value_str, rep_blanks(val[0])])
-                            self.d[field] = rep_blanks(self._true_value(value_str))
-            # move
-                ptr += 1
-                stack_ptr[-1] += 1
+                        base[field] = self._value(v)
+                elif type_ == 'scala_last':
+                    # 放到最后才做 %xxx% 的替换
+                    base[field] = rep_blanks(v)
+                    self._last = True
+                elif type_ == 'vec':
+                    base[field] = self._value(list_marker(rep_blanks(v),dir_))
+                elif type_ == 'vec_env':
+                    # 先读环境变量，若没有环境变量再读文件中的值
+                    if field in self.env:
+                        base[field] = self._value(rep_blanks(self.env[field]))
+                    else:
+                        base[field] = self._value(list_marker(rep_blanks(v),dir_))
+                elif type_ == 'vec_last':
+                    # 放到最后才做 %xxx% 的替换
+                    base[field] = rep_blanks(v)
+                    self._last = True
+                elif type_ == 'vec_start':
+                    parts = [rep_blanks(v)]
+                    ignore_vec = False
+                elif type_ == 'vec_start_env':
+                    # 先读环境变量，若没有环境变量再读文件中的值
+                    if field in self.env:
+                        base[field] = self._value(rep_blanks(self.env[field]))
+                        ignore_vec = True
+                    else:
+                        parts = [rep_blanks(v)]
+                        ignore_vec = False
+                elif type_ == 'vec_start_last':
+                    parts = [rep_blanks(v)]
+                    ignore_vec = False
+        # vector continued，各行先收集，结束时一次拼接
+            elif type_ in ['vec_mid','vec_end']:
+                if ignore_vec:
+                    continue
+                parts.append(rep_blanks(val[0]))
+                if type_ == 'vec_end':
+                    base[field] = self._value(' '.join(parts))
     # replace at last
-        if keys2rep:
-            for k in keys2rep:
-                self.d[k] = self._true_value(self.d[k])
-            for k in self.d:
-                self.d[k] = self._true_value(self.d[k])
-    # context
-        self.context = '\n'.join(self.lines)
-    # keys
-        self.keys = list(self.d.keys())
+        if self._last:
+            # 环境变量也会被替换，记下所有可能被替换的环境变量
+            self._env_used.update(marked_env(self.env))
+        if self.lazy:
+            self.d.resolve = self._resolve_key
+        else:
+            final = {}
+            keys = list(base)
+            if self._last:
+                keys += [k for k,v in self.env.items() if k not in base and ('%' in v or '$(' in v)]
+            if tr is not None:
+                tr.begin('resolve','resolve',keys=len(keys),last=self._last)
+            self._resolve(keys,final)
+            for k in keys:
+                base[k] = final[k]
+            if tr is not None:
+                tr.end()
+
+    @property
+    def keys(self):
+        '''
+        All of the keys of Ini object, including those added by :py:meth:`set <Ini.set>`.
+        '''
+        return list(self.d)
 
-    def _parse_pattern_type(self,s):
-        for key,pat in PATT.items():
-            content = re.findall(re.compile(pat),s)
-            if content: return key,content
-        return None,None
+    @property
+    def lines(self):
+        '''
+        Lines of all parsed files, with each include expanded between ``# START include``
+        and ``# END include`` marks.
+        '''
+        return self.context.split('\n')
+
+    @property
+    def context(self):
+        if self._context is None:
+            if any(lines is None for _,lines,_ in tree_files(self._tree)):
+                changed = self.changed_files()
+                if changed:
+                    print('Warning: context read from files changed since the parse: {}.'.format(', '.join(changed)))
+            self._context = '\n'.join(expand_tree(self._tree))
+        return self._context
 
-    def _true_value(self,s):
-        return self._run_command(self._replace_ref(s))
+    def _parse_pattern_type(self,s):
+        return classify_line(s)
 
-    def _run_command(self,s):
-        comm = parse_pattern(s,pCmd)
+    def _value(self,s,blank=True):
+        '''
+        Value of an assignment, with its references bound to the entries they point to now.
+        '''
+        binds = [(r,self._lookup(r.upper())) for r in _pRef.findall(s)] if '%' in s else []
+        return Deferred(s,binds,blank,self._location(),self._field)
+
+    def _p1(self,v):
+    # 解析时刻的值；只会引用更早的赋值，所以没有环
+        if not isinstance(v,Deferred):
+            return v
+        stack = [v]
+        while stack:
+            d = stack[-1]
+        # 值先于 binds 写入，binds 为 None 时值已就绪（懒解析时可能有别的线程刚算完）
+            binds = d.binds
+            if binds is None:
+                stack.pop()
+                continue
+            todo = [t for _,t in binds if isinstance(t,Deferred) and t.binds is not None]
+            if todo:
+                stack.extend(todo)
+                continue
+            stack.pop()
+            s = d.template
+            for r,t in binds:
+                s = s.replace('%{}%'.format(r),t.value if isinstance(t,Deferred) else t)
+            s = self._run_command(s,d.where,d.field)
+            d.value,d.binds = rep_blanks(s) if d.blank else s,None
+        return v.value
+
+    def _resolve(self,keys,final):
+        '''
+        Resolve the final values of *keys* into *final*, each key once, in topological order
+        of the ``%ref%`` dependencies. With ``$=`` keys the references left in the values are
+        looked up again under the last header, which is where cycles can appear.
+        '''
+        for key in keys:
+            if key in final:
+                continue
+            if not self._last:
+                final[key] = self._p1(self.d.raw(key))
+                continue
+            frames = [self._frame(key)]
+            onpath = {key:0}
+            while frames:
+                frame = frames[-1]
+                k,s,refs,i = frame
+                if i < len(refs):
+                    frame[3] += 1
+                    t = refs[i][1]
+                    if t in final:
+                        continue
+                    if t in onpath:
+                        raise INIRefError(self._cycle([f[0] for f in frames[onpath[t]:]]+[t]))
+                    onpath[t] = len(frames)
+                    frames.append(self._frame(t))
+                    continue
+                for r,t in refs:
+                    s = s.replace('%{}%'.format(r),final[t])
+                if '$(' in s:
+                    s = self._run_command(s,self._origin(k),k)
+                final[k] = s
+                frames.pop()
+                del onpath[k]
+
+    def _resolve_key(self,k):
+        self._resolve([k],self.d.final)
+        return self.d.final[k]
+
+    def _frame(self,k):
+        s = self._p1(self.d.raw(k))
+        refs = [(r,self._ref_key(r.upper(),k)) for r in _pRef.findall(s)] if '%' in s else []
+        return [k,s,refs,0]
+
+    def _origin(self,k):
+        return self._src.get(k,('<environment>',k))
+
+    def _where(self,k):
+        if k in getattr(self.d,'top',()):
+            return ('<set>',k)
+        return self._origin(k)
+
+    def _cycle(self,chain):
+        return 'Circular reference: {}.'.format(' -> '.join(
+                    '%{}% ( file: {}, line: {} )'.format(k,*self._origin(k)) for k in chain))
+
+    def _run_command(self,s,where,field):
+        comm = _pCmd.findall(s) if '$(' in s else None
         if comm:
+            cache = field not in self._nocache
+            for c in comm:
+                self._runner.submit(c,where,cache)
             for c in comm:
-                s = s.replace('$({})'.format(c),subprocess.getoutput(c))
+                out = self._runner.result(c,where,cache)
+                self._cmd_out[c] = out
+                s = s.replace('$({})'.format(c),out)
         return s
 
-    def _replace_ref(self,s):
-        ref = parse_pattern(s,pRef)
-        if ref:
-            for r in ref:
-                R = r.upper()
-                field = self._get_field(R)
-                if field in self.d: # 有在同一header下定义的key就先用它，不然再找[]下定义的同名key
-                    v = self.d[field]
-                else:
-                    v = self.d[R]
-                s = s.replace('%{}%'.format(r),v)
-        return s
+    def _location(self):
+        node,_,ptr,_ = self._stack[-1]
+        return node[0],ptr
+
+    def _lookup(self,R):
+        return self.d.raw(self._ref_key(R))
+
+    def _ref_key(self,R,k=None):
+    # 有在同一header下定义的key就先用它，不然再找[]下定义的同名key
+        field = self._get_field(R)
+        if not self.d.has_raw(field):
+            self._env_used.setdefault(field,None)
+            if not self.d.has_raw(R):
+                where = self._location() if k is None else self._origin(k)
+                raise INIRefError('Cannot find %{}% ( file: {}, line: {} ).'.format(R,*where))
+            field = R
+        env = self.d.env
+        if field in env:
+            self._env_used[field] = env[field]
+        return field
+
+    def _exists(self,path):
+        try:
+            return self._stat[path]
+        except KeyError:
+            out = self._stat[path] = os.path.exists(path)
+            return out
+
+    def _realpath(self,path):
+        try:
+            return self._real[path]
+        except KeyError:
+            out = self._real[path] = os.path.realpath(path)
+            return out
+
+    def _find_include(self,name,dir_,optional):
+        '''
+        Path of an included file, or None: *name* if absolute, else the first existing
+        one of *name* next to the including file and in the search path. Paths looked up
+        in vain are recorded as missing files, for the parse cache and reloads.
+        '''
+        if os.path.isabs(name):
+            cands = [name]
+        else:
+            cands = [os.path.join(d,name) for d in [dir_]+self.include_path]
+        retries = 0 if optional else self.include_retries
+        delay = self.include_backoff
+        traced = self._trace is not None and not any(self._exists(c) for c in cands)
+        if traced:
+            self._trace.begin('missing include','wait',file=cands[0],optional=optional,retries=retries)
+        found = None
+        for i in range(retries+1):
+            if i:
+                time.sleep(delay)
+                delay *= 2
+                for c in cands:
+                    self._stat.pop(c,None)
+            found = next((c for c in cands if self._exists(c)),None)
+            if found is not None:
+                break
+        for c in cands[:cands.index(found) if found is not None else len(cands)]:
+            self._files[c] = None
+        if traced:
+            self._trace.end(found=found,attempts=i+1)
+        return found
 
     def _get_field(self,key):
-        return '{}{}{}'.format(self.header,'~'*(self.header!=''),key.upper())
+        return sys.intern('{}{}{}'.format(self.header,'~'*(self.header!=''),key.upper()))
+
+    def _read_lines(self,fini):
+        '''
+        Lines of *fini* and their tokens, see :py:func:`tokenize`.
+        '''
+        if fini in self._reuse:
+            self._files[fini],lines,toks = self._reuse[fini]
+            return lines,toks
+        if self._trace is not None:
+            self._trace.begin('read','io',file=fini)
+        if self._file_cache is not None:
+            self._files[fini],lines,toks,cmds = self._file_cache.get(fini)
+        else:
+            self._files[fini],lines = read_file(fini)
+            toks,cmds = tokenize(lines),None
+        if self._trace is not None:
+            self._trace.end(bytes=self._files[fini][1],lines=len(lines),shared=cmds is not None)
+    # 提前并发执行不含 %..% 的命令
+        if self.lazy:
+            return lines,toks
+        nocache = {f.rpartition('~')[2] for f in self._nocache}
+        for c,i,k in scan_commands(lines) if cmds is None else cmds:
+            if k.upper() not in nocache:
+                self._runner.submit(c,(fini,i+1))
+        return lines,toks
+
+# cache
+    def _cache_path(self):
+        name = hashlib.sha1(self._builtin['PATH_FINI'].encode()).hexdigest()
+        return os.path.join(self.cache_dir,'{}.pkl'.format(name))
+
+    def _save_cache(self):
+        if self._trace is not None:
+            self._trace.begin('save cache','cache')
+            try:
+                return self._write_cache()
+            finally:
+                self._trace.end()
+        return self._write_cache()
+
+    def _write_cache(self):
+        d = {k:self.d[k] for k in self.d.base}
+        snap = { 'version'  : CACHE_VERSION,
+                 'path'     : self.include_path,
+                 'builtin'  : self._builtin,
+                 'files'    : self._files,
+                 'env'      : self._env_used,
+                 'cmd'      : self._cmd_out,
+                 'd'        : d,
+                 'src'      : self._src,
+                 'header'   : self.header,
+                 'tree'     : self._tree,
+                }
+        path = self._cache_path()
+        tmp = '{}.{}.tmp'.format(path,os.getpid())
+        try:
+            os.makedirs(self.cache_dir,exist_ok=True)
+            with open(tmp,'wb') as f:
+                pickle.dump(snap,f,protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp,path)
+        except OSError as e:
+            print('Warning: cannot write cache {} ({}).'.format(path,e))
+
+    def _load_cache(self):
+        if self._trace is not None:
+            self._trace.begin('load cache','cache')
+            hit = False
+            try:
+                hit = self._read_cache()
+                return hit
+            finally:
+                self._trace.end(hit=hit)
+        return self._read_cache()
+
+    def _read_cache(self):
+        try:
+            with open(self._cache_path(),'rb') as f:
+                snap = pickle.load(f)
+            if snap['version']!=CACHE_VERSION or snap['builtin']!=self._builtin or snap['path']!=self.include_path:
+                return False
+            if not env_matches(snap['env'],self.env):
+                return False
+            for fini,sig in snap['files'].items():
+                if not same_file(fini,sig): return False
+            where = (self._builtin['PATH_FINI'],0)
+            for c in snap['cmd']:
+                self._runner.submit(c,where)
+            for c,out in snap['cmd'].items():
+                if self._runner.result(c,where)!=out: return False
+        except Exception:
+            return False
+        self.d.base.update(snap['d'])
+        self._files,self._env_used,self._cmd_out = snap['files'],snap['env'],snap['cmd']
+        self._src,self.header,self._tree = snap['src'],snap['header'],snap['tree']
+        return True
 
     def __repr__(self):
         return self.context
 
     __str__ = __repr__
 
+    def __getstate__(self):
+        state = get_slots(self)
+        state['env'] = None
+        state['_callbacks'],state['_watcher'] = [],None
+        state['_file_cache'] = None
+        state.pop('_lock',None)
+        return state
+
+    def __setstate__(self,state):
+        set_slots(self,state)
+        self.env = environ()
+        self._lock = threading.RLock()
+
+# reload
+    def _reparse(self,changed):
+    # 在新对象上重新解析，未改动的文件用内存中的行，命令结果沿用 runner 里的
+        new = Ini.__new__(Ini)
+        for k in ['fini','cache_dir','lazy','memo_size','include_path','include_retries','include_backoff',
+                  'keep_source','dtypes','_file_cache','_nocache','_cmd_deadline','_runner']:
+            setattr(new,k,getattr(self,k))
+        new._init()
+        new._reuse = {f:(self._files[f],lines,toks) for f,lines,toks in tree_files(self._tree)
+                      if f not in changed and lines is not None}
+        runner = self._runner
+        runner.open(self._cmd_deadline)
+        if self._trace is not None:
+            runner.trace = new._trace = Tracer()
+            new._trace.begin('reload','ini',file=os.path.abspath(self.fini),changed=sorted(changed))
+        try:
+            new._parse_fini()
+        finally:
+            runner.close()
+            runner.deadline = None
+            if new._trace is not None:
+                new._trace.end()
+        new._done()
+        return new
+
+    def _changed_keys(self,new):
+        old,cur = self.d.base,new.d.base
+        keys = set(old).symmetric_difference(cur)
+        if self.lazy:
+            # 只比较读过的值，没读过的下次读时自然是新值
+            for k,v in self.d.final.items():
+                if k in cur and new.d[k]!=v:
+                    keys.add(k)
+        else:
+            keys.update(k for k,v in old.items() if k in cur and cur[k]!=v)
+        return keys
+
 #---------------------- For Users ----------------------
     def exists(self,field:str) -> bool:
         '''
@@ -255,7 +822,225 @@ class Ini():
         ------------
         val : bool
         '''
-        return field.upper() in self.keys
+        return field.upper() in self.d
+
+    def changed_files(self) -> list:
+        '''
+        Files of the include tree changed since the last parse, with one ``stat`` per file.
+        Includes that were missing and now exist are reported too.
+        '''
+        return [f for f,sig in list(self._files.items()) if not same_file(f,sig)]
+
+    def reload(self,force:bool=False) -> set:
+        '''
+        Parse again if any file of the include tree changed, and call the callbacks
+        registered by :py:meth:`watch <Ini.watch>` with the changed keys.
+
+        Unchanged files are neither read nor tokenized again, and ``$(...)`` commands
+        already run are not run again, but the assignments of all files are replayed and
+        every key resolved again, since a changed file can change the values of keys
+        defined in the others. Reloading the 'mixed' benchmark (13 files, about 2000 keys)
+        after editing one file takes about a third of a full parse. Values set by
+        :py:meth:`set <Ini.set>` are kept.
+
+        Parameters
+        -------------
+        force : bool, optional (default=False)
+            Parse again even if no file changed, e.g. after the environment changed.
+
+        Returns
+        ------------
+        keys : set
+            Keys added, removed or whose value changed. In lazy mode only the values
+            already read are compared.
+        '''
+        with self._lock:
+            changed = self.changed_files()
+            if not changed and not force:
+                return set()
+            new = self._reparse(set(changed))
+            keys = self._changed_keys(new)
+            new.d.top = self.d.top
+            memo = OrderedDict((k,v) for k,v in list(self._memo.items()) if k[0] not in keys)
+        # 整体替换解析结果：其他槽位先换，再换 Store，最后换 memo，
+        # 读者看到的要么是旧的要么是新的 Store，且 memo 不会比 Store 新
+            state = get_slots(new)
+            del state['d'],state['_memo']
+            set_slots(self,state)
+            self.d = new.d
+            self._memo = memo
+            if self.cache_dir is not None:
+                self._save_cache()
+        for callback in list(self._callbacks):
+            callback(keys)
+        return keys
+
+    def watch(self,callback=None,interval:float=1.0):
+        '''
+        Poll the include tree in a background thread and :py:meth:`reload <Ini.reload>`
+        on changes.
+
+        Parameters
+        -------------
+        callback : callable, optional (default=None)
+            Called as ``callback(keys)`` with the set of changed keys after each reload.
+        interval : float, optional (default=1.0)
+            Seconds between two polls.
+        '''
+        if callback is not None:
+            self._callbacks.append(callback)
+        if self._watcher is not None:
+            return
+        stop = self._watcher = threading.Event()
+        def loop():
+            while not stop.wait(interval):
+                try:
+                    self.reload()
+                except Exception as e:
+                    print('Warning: reload of {} failed ({}).'.format(self.fini,e))
+        threading.Thread(target=loop,name='ini-watch',daemon=True).start()
+
+    def unwatch(self):
+        '''
+        Stop the thread started by :py:meth:`watch <Ini.watch>` and drop the callbacks.
+        '''
+        if self._watcher is not None:
+            self._watcher.set()
+            self._watcher = None
+        self._callbacks = []
+
+    def section(self,name:str) -> 'Section':
+        '''
+        Live view of the fields under a header, consistent with :py:meth:`set <Ini.set>`.
+
+        Parameters
+        -------------
+        name : str
+            Name of the header, ``''`` for the fields outside of any header.
+
+        Returns
+        ------------
+        val : Section
+            Read-only mapping from the names without header to the values, with the
+            ``find*``/``get*`` accessors of the Ini object.
+        '''
+        return Section(self,name)
+
+    def match(self,pattern:str) -> list:
+        '''
+        Fields matching a shell-style pattern, e.g. ``'RISK~*LIMIT'`` or ``'*~N'``, as
+        :py:func:`fnmatch.fnmatch` on the whole field: ``*`` also spans ``~``, so that
+        ``'RISK~*'`` matches ``RISK~SUB~QLIMIT`` too.
+
+        If the part before the last ``~`` has no wildcard and the part after it has no ``*``
+        nor ``[...]``, only that header is scanned, so the cost is the size of that section.
+        Otherwise only the headers that can start with the literal prefix of *pattern* are
+        scanned.
+
+        Parameters
+        -------------
+        pattern : str
+            Pattern with ``*``, ``?`` and ``[...]``, case ignored.
+
+        Returns
+        ------------
+        val : list
+            Matching fields, grouped by header: headers in the order they first appear,
+            fields of one header in the order of :py:attr:`keys <Ini.keys>`. With
+            ``[A] X``, ``[B] Y``, ``[A] Z``, ``'*'`` gives ``A~X, A~Z, B~Y``.
+        '''
+        pattern = pattern.upper()
+        header = header_of(pattern)
+        name = pattern[len(header)+1:] if header else pattern
+        test = re.compile(fnmatch.translate(pattern)).match
+        if not _pGlob.search(header) and '*' not in name and '[' not in name:
+            return [k for k in self.d.section(header) if test(k)]
+    # 通配符可以跨过 '~'：按通配符前的字面前缀挑 header
+        m = _pGlob.search(pattern)
+        lit = pattern[:m.start()] if m else pattern
+        def may_match(h):
+            if not h:
+                return '~' not in lit
+            return h.startswith(lit) or lit.startswith(h+'~')
+        return [k for h in self.d.headers() if may_match(h) for k in self.d.section(h) if test(k)]
+
+# diff
+    def _digests(self,env,builtin):
+    # 每个 header 的 (值的哈希, 排好序的字段)，按选项缓存到对象改变为止
+    # 缓存记着算它时的 Store 和运行时层，两者被替换后作废
+        d = self.d
+        top = getattr(d,'top',None)
+        cache = self._digest
+        if cache is None or cache[0] is not d or cache[1] is not top:
+            cache = self._digest = (d,top,{})
+        out = cache[2].get((env,builtin))
+        if out is not None:
+            return out
+        skip = () if builtin else BUILTIN_KEYS
+        if env:
+            keep = lambda k: k not in skip
+        elif isinstance(d,Store):
+            keep = lambda k: k not in skip and (k in d.base or k in top)
+        else:
+            # 快照里不分层，与当前环境变量相同的键算作环境变量
+            cur = environ()
+            keep = lambda k: k not in skip and cur.get(k)!=d[k]
+        out = {}
+        for h in d.headers():
+            fields = sorted(filter(keep,d.section(h)))
+            if fields:
+                digest = hashlib.blake2b(digest_size=16)
+                for k in fields:
+                    digest.update('{}\0{}\0'.format(k,d[k]).encode())
+                out[h] = (digest.digest(),fields)
+        cache[2][(env,builtin)] = out
+        return out
+
+    def diff(self,other:'Ini'=None,env:bool=False,builtin:bool=False) -> 'IniDiff':
+        '''
+        Keys added, removed and changed from this object to *other*, by section, with the
+        file and line where each value is defined.
+
+        Sections are compared first by a hash of their values, kept on each object until it
+        changes, so that comparing many objects with one reference only goes through the
+        keys of the sections that differ.
+
+        Parameters
+        -------------
+        other : Ini, optional (default=None)
+            Object to compare with. If None, the files are parsed again as
+            :py:meth:`reload <Ini.reload>` would, keeping the values set by
+            :py:meth:`set <Ini.set>`, and this object is left unchanged.
+        env : bool, optional (default=False)
+            If True, also compare the keys that only come from the environment.
+        builtin : bool, optional (default=False)
+            If True, also compare ``PATH_FINI``, ``CUR_DIR``, ``TODAY`` and ``DATE``.
+
+        Returns
+        ------------
+        val : IniDiff
+            The changes, sorted by section and field.
+        '''
+        if other is None:
+            other = self._reparse(set(self.changed_files()))
+            other.d.top = self.d.top
+        old,new = self._digests(env,builtin),other._digests(env,builtin)
+        changes = []
+        for h in sorted(set(old)|set(new)):
+            a,b = old.get(h),new.get(h)
+            if a is not None and b is not None and a[0]==b[0]:
+                continue
+            fa,fb = set(a[1] if a else ()),set(b[1] if b else ())
+            for k in sorted(fa|fb):
+                if k not in fb:
+                    changes.append(Change('-',k,self.d[k],None,self._where(k),None))
+                elif k not in fa:
+                    changes.append(Change('+',k,None,other.d[k],None,other._where(k)))
+                else:
+                    va,vb = self.d[k],other.d[k]
+                    if va!=vb:
+                        changes.append(Change('~',k,va,vb,self._where(k),other._where(k)))
+        return IniDiff(changes)
 
     def set(self,field:str,val:Union[str,int,float,bool,list]):
         '''
@@ -265,10 +1050,50 @@ class Ini():
         --------------
         field : str
             Name of the field.
-        val : str, int, float, bool or list
-            Value of the content.
+        val : str, int, float, bool, list or 1-d numpy.ndarray
+            Value of the content. Lists and arrays are stored as a vector. A copy of an
+            array of one of the ``ARRAY_DTYPES`` is kept as it is and served by
+            :py:meth:`findArray <Ini.findArray>` with its dtype (and by
+            :py:meth:`findNumVec <Ini.findNumVec>`/:py:meth:`findIntVec <Ini.findIntVec>`
+            for float64/int64); its string is built on the first read of the string
+            value (:py:meth:`find <Ini.find>`, :py:meth:`diff <Ini.diff>`,
+            :py:meth:`export <Ini.export>`, ...).
+        '''
+        self.update({field:val})
+
+    def update(self,values:dict):
+        '''
+        Set many pieces of content at once, see :py:meth:`set <Ini.set>`.
+
+        Readers in other threads see either none or all of *values*: the new values and
+        the typed values kept for them are published together, and readers never wait.
+        Writes of :py:meth:`set <Ini.set>`, :py:meth:`update <Ini.update>` and
+        :py:meth:`reload <Ini.reload>` are serialized.
+
+        Parameters
+        --------------
+        values : dict
+            ``{field: val}``, with values as in :py:meth:`set <Ini.set>`.
         '''
-        self.d[field.upper()] = str(val)
+        items = {}
+        for field,val in values.items():
+            field = field.upper()
+            vec = isinstance(val,(list,tuple)) or getattr(val,'ndim',0)==1
+            if vec and getattr(getattr(val,'dtype',None),'name',None) in ARRAY_DTYPES:
+            # 数组原样保存，字符串等到读取时才拼
+                a = np.array(val)
+                a.flags.writeable = False
+                items[field] = ArrayValue(a)
+            elif vec:
+                items[field] = ' '.join(str(x) for x in (val.tolist() if hasattr(val,'tolist') else val))
+            else:
+                items[field] = str(val)
+        with self._lock:
+        # 新 memo 不含这些键；先发布新的运行时层，再发布 memo，
+        # 读者拿到新 memo 时一定也能看到新值，拿着旧 memo 算出的值只写进旧 memo
+            memo = OrderedDict((k,v) for k,v in list(self._memo.items()) if k[0] not in items)
+            self.d.set_many(items)
+            self._memo = memo
     
 # find
     def _find(self,field:str,**kwargs):
@@ -276,6 +1101,32 @@ class Ini():
         s = replace(s,**kwargs)
         return s
 
+    def _typed(self,field:str,kwargs:dict,conv):
+    # set 写入的数组按原 dtype 直接返回，不经过字符串，也不占 memo
+        v = getattr(self.d,'top',{}).get(field.upper())
+        if type(v) is ArrayValue:
+            dtype = v.array.dtype.name
+            if getattr(conv,'dtype',None)==dtype or (conv is as_num_vec and dtype=='float64') \
+                    or (conv is as_int_vec and dtype=='int64'):
+                return v.array
+        if not self.memo_size:
+            return typed(self._find(field,**kwargs),conv)
+        memo = self._memo
+        key = (field.upper(),conv,tuple(kwargs.items()))
+        try:
+            out = memo[key]
+            memo.move_to_end(key)
+        except KeyError:
+            out = typed(self._find(field,**kwargs),conv)
+            if isinstance(out,np.ndarray):
+                out.flags.writeable = False
+            memo[key] = out
+            if len(memo) > self.memo_size:
+                memo.popitem(last=False)
+        except TypeError:   # unhashable kwargs
+            return typed(self._find(field,**kwargs),conv)
+        return list(out) if isinstance(out,list) else out
+
     def find(self,field:str,**kwargs):
         '''
         Return string-format value of the *field*, and substitue patterns of ``$..$`` with *kwargs*.
@@ -293,8 +1144,7 @@ class Ini():
         ----------------
         val : str or None
         '''
-        v = self._find(field,**kwargs)
-        return None if v.lower()=='none' else v
+        return self._typed(field,kwargs,as_str)
 
     findString = find
 
@@ -304,6 +1154,9 @@ class Ini():
 
         If the original value of the field in lower-case equals 'none', then return ``None``
 
+        A field written ``key = [<path>]`` reads its items from an external list file, one
+        per line, on first use, see :py:func:`list_file`.
+
         Parameters
         -------------
         field : str
@@ -315,8 +1168,7 @@ class Ini():
         ----------------
         val : list of strings or None
         '''
-        v = self._find(field,**kwargs)
-        return None if v.lower()=='none' else [s for s in v.split(' ') if s]
+        return self._typed(field,kwargs,as_str_vec)
 
     def findBool(self,field:str,**kwargs):
         '''
@@ -333,8 +1185,7 @@ class Ini():
         ----------------
         val : bool or None
         '''
-        v = self._find(field,**kwargs)
-        return None if v.lower()=='none' else str2bool(v)
+        return self._typed(field,kwargs,as_bool)
     
     def findBoolVec(self,field:str,**kwargs):
         '''
@@ -353,13 +1204,7 @@ class Ini():
         ----------------
         val : list of bools or None
         '''
-        v = self._find(field,**kwargs)
-        if v.lower()=='none':
-            out = None
-        else:
-            value = [s for s in v.split(' ') if s]
-            out = [str2bool(v) for v in value]
-        return out
+        return self._typed(field,kwargs,as_bool_vec)
 
     def findInt(self,field:str,**kwargs):
         '''
@@ -378,8 +1223,7 @@ class Ini():
         ----------------
         val : int or None
         '''
-        v = self._find(field,**kwargs)
-        return None if v.lower()=='none' else int(v)
+        return self._typed(field,kwargs,as_int)
     
     def findIntVec(self,field:str,**kwargs):
         '''
@@ -398,13 +1242,11 @@ class Ini():
         ----------------
         val : numpy.ndarray or None
         '''
-        v = self._find(field,**kwargs)
-        if v.lower()=='none':
-            out = None
-        else:
-            value = [s for s in v.split(' ') if s]
-            out = np.array([int(float(v)) for v in value])
-        return out
+        if self.dtypes:
+            dtype = self._dtype_of(field)
+            if dtype is not None and dtype.startswith('int'):
+                return self.findArray(field,dtype,**kwargs)
+        return self._typed(field,kwargs,as_int_vec)
         
     def findNum(self,field:str,**kwargs):
         '''
@@ -423,8 +1265,7 @@ class Ini():
         ----------------
         val : float or None
         '''
-        v = self._find(field,**kwargs)
-        return None if v.lower()=='none' else float(v)
+        return self._typed(field,kwargs,as_num)
 
 
     def findNumVec(self,field:str,**kwargs):
@@ -433,6 +1274,9 @@ class Ini():
 
         If the original value of the field in lower-case equals 'none', then return ``None``
 
+        A field written ``key = [<path>]`` reads its items from an external list file on
+        first use, see :py:func:`list_file`; a ``.npy`` file of float64 is memory-mapped.
+
         Parameters
         -------------
         field : str
@@ -444,13 +1288,48 @@ class Ini():
         ----------------
         val : numpy.ndarray or None
         '''
-        v = self._find(field,**kwargs)
-        if v.lower()=='none':
-            out = None
-        else:
-            value = [s for s in re.split(' |,', v.strip('[').strip(']')) if s]
-            out = np.array([float(v) for v in value])
-        return out
+        if self.dtypes:
+            dtype = self._dtype_of(field)
+            if dtype is not None and dtype.startswith('float'):
+                return self.findArray(field,dtype,**kwargs)
+        return self._typed(field,kwargs,as_num_vec)
+
+    def findArray(self,field:str,dtype:Union[str,type]=None,**kwargs):
+        '''
+        Return the vector value of the *field* as a read-only array of *dtype*, and substitue
+        patterns of ``$..$`` with *kwargs* for each element. The value is parsed once and
+        the next calls return the same array (see *memo_size* of :py:class:`Ini`).
+
+        If the original value of the field in lower-case equals 'none', then return ``None``
+
+        Parameters
+        -------------
+        field : str
+            Name of the field.
+        dtype : str or type, optional (default=None)
+            One of ``'int32'``, ``'int64'``, ``'float32'``, ``'float64'``, ``'bool'``, or
+            ``'str'`` for a :py:class:`StringArray`. If None, the dtype declared for the
+            field with *dtypes* of :py:class:`Ini`, else ``'float64'``. Integers are
+            truncated like :py:meth:`findIntVec <Ini.findIntVec>` does.
+        **kwargs 
+            Key-value pairs for substitution.
+
+        Returns
+        ----------------
+        val : numpy.ndarray, StringArray or None
+        '''
+        if dtype is None:
+            dtype = self.dtypes and self._dtype_of(field) or 'float64'
+        return self._typed(field,kwargs,as_array(dtype))
+
+    def _dtype_of(self,field):
+        field = field.upper()
+        dtype = self.dtypes.get(field)
+        if dtype is None:
+            for pattern,dt in self.dtypes.items():
+                if fnmatch.fnmatchcase(field,pattern):
+                    return dt
+        return dtype
     
     findFloat = findNum
     findFloatVec = findNumVec
@@ -475,10 +1354,20 @@ class Ini():
         ----------------
         val : str or None or type of *value*
         '''
-        return self.find(field,**kwargs) if self.exists(field) else value
+        return self._get(self.find,field,value,(),kwargs)
     
     getString = get
 
+    def _get(self,find,field,value,args,kwargs,conv=None):
+    # 检查之后、读取之前键被 reload 删掉时，也按不存在返回 value；conv 只在不存在时转换 value
+        if field.upper() in self.d:
+            try:
+                return find(field,*args,**kwargs)
+            except KeyError:
+                if field.upper() in self.d:
+                    raise
+        return value if conv is None or value is None else conv(value)
+
     def getStringVec(self,field:str,value:Any=None,**kwargs):
         '''
         If *field* exists, equivalent to :py:meth:`findStringVec <Ini.findStringVec>`; else, return *value*.
@@ -498,7 +1387,7 @@ class Ini():
         ----------------
         val : list of str or None or type of *value*
         '''
-        return self.findStringVec(field,**kwargs) if self.exists(field) else value
+        return self._get(self.findStringVec,field,value,(),kwargs)
 
     def getBool(self,field:str,value:Any=None,**kwargs):
         '''
@@ -519,7 +1408,7 @@ class Ini():
         ----------------
         val : bool or None or type of *value*
         '''
-        return self.findBool(field,**kwargs) if self.exists(field) else value
+        return self._get(self.findBool,field,value,(),kwargs)
     
     def getBoolVec(self,field:str,value:Any=None,**kwargs):
         '''
@@ -540,7 +1429,7 @@ class Ini():
         ----------------
         val : list of bools or None or type of *value*
         '''
-        return self.findBoolVec(field,**kwargs) if self.exists(field) else value
+        return self._get(self.findBoolVec,field,value,(),kwargs)
 
     def getInt(self,field:str,value:Any=None,**kwargs):
         '''
@@ -561,7 +1450,7 @@ class Ini():
         ----------------
         val : int or None or type of *value*
         '''
-        return self.findInt(field,**kwargs) if self.exists(field) else value
+        return self._get(self.findInt,field,value,(),kwargs)
     
     def getIntVec(self,field:str,value:Any=None,**kwargs):
         '''
@@ -582,7 +1471,7 @@ class Ini():
         ----------------
         val : numpy.ndarray or None
         '''
-        return self.findIntVec(field,**kwargs) if self.exists(field) else None if value is None else np.array(value).astype(int)
+        return self._get(self.findIntVec,field,value,(),kwargs,lambda v: np.array(v).astype(int))
         
     def getNum(self,field:str,value:Any=None,**kwargs):
         '''
@@ -603,7 +1492,7 @@ class Ini():
         ----------------
         val : float or None or type of *value*
         '''
-        return self.findNum(field,**kwargs) if self.exists(field) else value
+        return self._get(self.findNum,field,value,(),kwargs)
 
     def getNumVec(self,field:str,value:Any=None,**kwargs):
         '''
@@ -624,49 +1513,1921 @@ class Ini():
         ----------------
         val : numpy.ndarray or None
         '''
-        return self.findNumVec(field,**kwargs) if self.exists(field) else None if value is None else np.array(value).astype(float)
+        return self._get(self.findNumVec,field,value,(),kwargs,lambda v: np.array(v).astype(float))
+
+    def getArray(self,field:str,value:Any=None,dtype:Union[str,type]=None,**kwargs):
+        '''
+        If *field* exists, equivalent to :py:meth:`findArray <Ini.findArray>`; else, return *value*.
+
+        Parameters
+        -------------
+        field : str
+            Name of the field.
+        value : any type, optional (default=None)
+            Value to return if *field* deos not exists.
+        dtype : str or type, optional (default=None)
+            See :py:meth:`findArray <Ini.findArray>`.
+        **kwargs 
+            Key-value pairs for substitution.
+
+        Returns
+        ----------------
+        val : numpy.ndarray, StringArray or None or type of *value*
+        '''
+        return self._get(self.findArray,field,value,(dtype,),kwargs)
     
     getFloat = getNum
     getFloatVec = getNumVec
 
+# bulk
+    def render(self,field:str,params,array:bool=False,strict:bool=True):
+        '''
+        Render the ``$..$`` patterns of a field for many sets of kwargs in one call, e.g.
+        ``ini.render('Replace', {'dt': dates})``.
+
+        Parameters
+        -------------
+        field : str
+            Name of the field.
+        params : list of dict, dict or numpy structured array
+            Kwargs of each rendering: a list of dicts, a dict of equal-length columns
+            (strings and scalars are used for every rendering) or a structured array.
+        array : bool, optional (default=False)
+            If True, return a numpy string array instead of a list.
+        strict : bool, optional (default=True)
+            If True, raise when a placeholder is left without a value. Otherwise leave it
+            in place, like :py:meth:`find <Ini.find>`.
+
+        Returns
+        ----------------
+        val : list or numpy.ndarray
+            One string per set of kwargs, None where the value is 'none' (lists only).
+
+        Raises
+        ----------------
+        INITemplateError
+            Listing the placeholders without a value, if *strict*.
+        '''
+        s = self.d[field.upper()]
+        t = compile_template(s)
+        missing = set()
+        if isinstance(params,np.ndarray) and params.dtype.names:
+            params = {k:params[k] for k in params.dtype.names}
+        elif not isinstance(params,Mapping):
+            params = list(params)
+        if t is not None and t.gaps:
+            keys = params if isinstance(params,Mapping) else {k for row in params for k in row}
+            if not t.gaps.isdisjoint(keys):
+                t = None
+        if t is not None:
+            n,cols = param_columns(params,set(t.names))
+            out = render_columns(t,n,cols,missing)
+            if out is None:
+                t = None
+                missing.clear()
+        if t is None:
+            # 有歧义的模板按每组 kwargs 的顺序逐个替换
+            if isinstance(params,Mapping):
+                n,cols = param_columns(params,list(params))
+                params = [{k:v[i] for k,v in cols.items()} for i in range(n)]
+            out = [replace(s,**row) for row in params]
+            missing.update(m for v in out for m in _pRep.findall(v))
+        if missing and strict:
+            raise INITemplateError('No value for {} in \'{}\' ( file: {}, line: {} ).'.format(
+                    ', '.join('${}$'.format(n) for n in sorted(missing)),s,*self._origin(field.upper())),sorted(missing))
+        if array:
+            return np.array(out,dtype=str)
+        return [as_str(v) for v in out]
+
+    def stats(self) -> dict:
+        '''
+        Timings of the last parse (or reload), if the object was made with ``trace=True``.
+
+        Returns
+        ----------------
+        val : dict or None
+            Totals (``time``, ``files``, ``lines``, ``bytes``, ``max_depth``, ``read_time``,
+            ``missing_includes``, ``wait_time``, ``commands``, ``commands_run``,
+            ``command_time``, ``command_bytes``, ``resolve_time``) and the tree of
+            ``spans``, each ``{name, cat, start, dur, tid, args, children}`` with times in
+            seconds. None if not traced.
+        '''
+        return None if self._trace is None else self._trace.stats()
+
+    def export_trace(self,path:str,format:str='chrome'):
+        '''
+        Write the trace of the last parse to a file.
+
+        Parameters
+        -------------
+        path : str
+            Output file.
+        format : str, optional (default='chrome')
+            ``'chrome'`` for the Trace Event format of ``chrome://tracing`` and Perfetto,
+            ``'json'`` for the output of :py:meth:`stats <Ini.stats>`.
+        '''
+        if self._trace is None:
+            raise ValueError('Ini was not made with trace=True.')
+        if format not in ['chrome','json']:
+            raise ValueError('Unknown trace format \'{}\'.'.format(format))
+        out = self._trace.chrome() if format=='chrome' else self._trace.stats()
+        with open(path,'w') as f:
+            json.dump(out,f,indent=1)
+
+    def extract(self,spec:dict,record:bool=False,**kwargs):
+        '''
+        Return values of many fields in one call.
+
+        Parameters
+        -------------
+        spec : dict
+            ``{field: type}`` or ``{field: (type, default)}``. *type* is the suffix of a
+            ``find*`` accessor, e.g. ``'Int'``, ``'NumVec'`` or ``'String'`` (case ignored),
+            or one of ``str``, ``int``, ``float`` and ``bool``. Fields with a default behave
+            like ``get*``, the others like ``find*``.
+        record : bool, optional (default=False)
+            If True, return a numpy structured record instead of a dict.
+        **kwargs 
+            Key-value pairs for substitution, applied to every field.
+
+        Returns
+        ----------------
+        val : dict or numpy.record
+            Values keyed by the fields as given in *spec*.
+
+        Raises
+        ----------------
+        INIExtractError
+            Listing every field that is missing or cannot be converted.
+        '''
+        out,errors = {},{}
+        for field,typ in spec.items():
+            has_default = isinstance(typ,tuple)
+            if has_default:
+                typ,default = typ
+            conv = CONVERTERS.get(typ.lower() if isinstance(typ,str) else typ)
+            if conv is None:
+                errors[field] = 'unknown type {!r}'.format(typ)
+            elif field.upper() not in self.d:
+                if has_default:
+                    out[field] = default if default is None or conv not in DEFAULT_CAST else DEFAULT_CAST[conv](default)
+                else:
+                    errors[field] = 'missing'
+            else:
+                try:
+                    out[field] = self._typed(field,kwargs,conv)
+                except Exception as e:
+                    errors[field] = '{}: {}'.format(type(e).__name__,e)
+        if errors:
+            raise INIExtractError(errors)
+        return to_record(out) if record else out
+
+# snapshot
+    def export(self,path:str):
+        '''
+        Write the resolved values to a binary snapshot that :py:class:`IniMap` opens with
+        mmap, for workers that need the values without parsing.
+
+        Parameters
+        -------------
+        path : str
+            File to write, replaced atomically. The ``dtypes`` table is written too.
+        '''
+        write_map(path,[(k,self.d[k]) for k in self.d],self.context,self.dtypes)
+
+
+#%% Lazy values
+class Deferred():
+    '''
+    Value of an assignment that is resolved on first use. References are bound to the
+    entries they point to at the time of the assignment.
+    '''
+    __slots__ = ['template','binds','blank','where','field','value']
+
+    def __init__(self,template,binds,blank,where,field):
+        self.template = template
+        self.binds = binds
+        self.blank = blank
+        self.where = where
+        self.field = field
+        self.value = None
+
+class ArrayValue():
+    '''
+    Array written by :py:meth:`Ini.set`, kept in the runtime layer of :py:class:`Store` as
+    it is. Its string, the items joined by spaces, is built on the first read.
+    '''
+    __slots__ = ['array','_s']
+
+    def __init__(self,array:np.ndarray):
+        self.array = array
+        self._s = None
+
+    def __str__(self):
+        s = self._s
+        if s is None:
+            s = self._s = ' '.join(map(str,self.array.tolist()))
+        return s
+
+    def __getstate__(self):
+        return self.array
+
+    def __setstate__(self,state):
+        self.__init__(state)
+
+class Store(MutableMapping):
+    '''
+    Layered key store of an Ini object. Lookups go through the runtime layer of
+    :py:meth:`Ini.set`, then the layer of the parsed files (and builtins), then the shared
+    read-only environment, so that the environment is never copied.
+
+    In lazy mode, ``resolve(key)`` is called on the first read of a parsed key and stores
+    the final value into *final*.
+
+    The runtime layer is copy-on-write: each write publishes a new *top* dict in one
+    assignment, so that readers in other threads never see a dict being changed. Arrays
+    are kept there as :py:class:`ArrayValue`, typed, and read as strings.
+    '''
+    __slots__ = ['env','base','top','final','resolve','_index','_top_index']
+
+    def __init__(self,env:Mapping,base:dict=None):
+        self.env = env
+        self.base = {} if base is None else base
+        self.top = {}
+        self.final = {}
+        self.resolve = None
+        self._index = None      # [env, base] header -> {field: None}, built on first query
+        self._top_index = None  # (top, its header index), built again when top is replaced
+
+    def raw(self,k):
+        '''
+        Parsed value of *k*, unresolved in lazy mode, ignoring the runtime layer.
+        '''
+        try:
+            return self.base[k]
+        except KeyError:
+            return self.env[k]
+
+    def has_raw(self,k):
+        return k in self.base or k in self.env
+
+    def __getitem__(self,k):
+        try:
+            v = self.top[k]
+        except KeyError:
+            pass
+        else:
+            return str(v) if type(v) is ArrayValue else v
+        if self.resolve is None:
+            return self.raw(k)
+        try:
+            return self.final[k]
+        except KeyError:
+            pass
+        if not self.has_raw(k):
+            raise KeyError(k)
+        return self.resolve(k)
+
+    def __setitem__(self,k,v):
+        self.set_many({k:v})
+
+    def __delitem__(self,k):
+        top = dict(self.top)
+        del top[k]
+        self.top = top
+
+    def set_many(self,items:dict):
+        '''
+        Write *items* into the runtime layer at once: readers see all of them or none.
+        '''
+        top = dict(self.top)
+        top.update(items)
+        self.top = top
+
+    def _headers(self):
+        idx = self._index
+        if idx is None:
+            idx = self._index = [env_index(self.env),index_headers(self.base)]
+    # 运行时层的索引跟着 top 对象走，top 被替换后重建
+        top = self.top
+        t = self._top_index
+        if t is None or t[0] is not top:
+            t = self._top_index = (top,index_headers(top))
+        return idx+[t[1]]
+
+    def reindex(self):
+        '''
+        Drop the header index, to be called after writing *base* directly.
+        '''
+        self._index = self._top_index = None
+
+    def headers(self) -> list:
+        '''
+        Names of all headers, ``''`` for the fields outside of any header.
+        '''
+        out = {}
+        for idx in self._headers():
+            out.update(dict.fromkeys(idx))
+        return list(out)
+
+    def section(self,header:str) -> list:
+        '''
+        Fields under *header*, in the order of iteration.
+        '''
+        out = {}
+        for idx in self._headers():
+            out.update(idx.get(header,()))
+        return list(out)
+
+    def __contains__(self,k):
+        return k in self.top or k in self.base or k in self.env
+
+    def __iter__(self):
+        env,base,top = self.env,self.base,self.top
+        yield from env
+        for k in base:
+            if k not in env:
+                yield k
+        for k in top:
+            if k not in base and k not in env:
+                yield k
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __getstate__(self):
+    # 环境变量层不随对象保存，恢复时用当前进程的
+        state = get_slots(self)
+        state['env'] = None
+        state['_index'] = state['_top_index'] = None
+        return state
+
+    def __setstate__(self,state):
+        set_slots(self,state)
+        self.env = environ()
+
+class Section(Mapping):
+    '''
+    Live view of the fields under one header of an Ini object, keyed by the names without
+    the header. ``find*``/``get*`` accessors take those names too, e.g.
+    ``ini.section('TCL').findInt('N')`` is ``ini.findInt('TCL~N')``.
+    '''
+    def __init__(self,ini,name:str):
+        self.ini = ini
+        self.name = name.upper()
+        self._prefix = self.name+'~' if self.name else ''
+
+    def field(self,key:str) -> str:
+        return self._prefix+key.upper()
+
+    def __getitem__(self,key):
+        return self.ini.d[self.field(key)]
+
+    def __contains__(self,key):
+        return isinstance(key,str) and self.field(key) in self.ini.d
+
+    def __iter__(self):
+        n = len(self._prefix)
+        for k in self.ini.d.section(self.name):
+            yield k[n:]
+
+    def __len__(self):
+        return len(self.ini.d.section(self.name))
+
+    def __getattr__(self,name):
+        if not name.startswith(('find','get')) or not hasattr(self.ini,name):
+            raise AttributeError(name)
+        method = getattr(self.ini,name)
+        return lambda key,*args,**kwargs: method(self.field(key),*args,**kwargs)
+
+    def __repr__(self):
+        return 'Section({!r}, {})'.format(self.name,dict(self.items()))
+
+#%% Arrays
+class StringArray(Sequence):
+    '''
+    Read-only vector of strings kept as one buffer and the offsets of its items, as
+    returned by :py:meth:`Ini.findArray` for ``'str'``. Items are made on access.
+    '''
+    __slots__ = ['buf','offsets']
+
+    def __init__(self,items:list):
+        items = list(map(str,items))
+        off = np.zeros(len(items)+1,dtype=np.int64)
+        np.cumsum(np.fromiter(map(len,items),np.int64,len(items)),out=off[1:])
+        off.flags.writeable = False
+        self.buf = ''.join(items)
+        self.offsets = off
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            return StringArray([self[j] for j in range(*i.indices(len(self)))])
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('StringArray index out of range')
+        return self.buf[self.offsets[i]:self.offsets[i+1]]
+
+    def __iter__(self):
+        buf,off = self.buf,self.offsets.tolist()
+        for i in range(len(off)-1):
+            yield buf[off[i]:off[i+1]]
+
+    def tolist(self) -> list:
+        return list(self)
+
+    def __eq__(self,other):
+        if isinstance(other,(StringArray,list,tuple)):
+            return len(self)==len(other) and all(a==b for a,b in zip(self,other))
+        return NotImplemented
+
+    def __repr__(self):
+        return 'StringArray({!r})'.format(self.tolist())
+
+#%% Diff
+class Change():
+    '''
+    One key added (``'+'``), removed (``'-'``) or changed (``'~'``) in an :py:class:`IniDiff`,
+    with its values and their ``(file, line)`` on both sides, None on the missing side.
+    '''
+    __slots__ = ['kind','field','old','new','old_src','new_src']
+
+    def __init__(self,kind,field,old,new,old_src,new_src):
+        self.kind = kind
+        self.field = field
+        self.old = old
+        self.new = new
+        self.old_src = old_src
+        self.new_src = new_src
+
+    def __str__(self):
+        name = self.field.rpartition('~')[2]
+        if self.kind == '~':
+            return '~ {} = {} -> {} ( file: {}, line: {} )'.format(name,self.old,self.new,*self.new_src)
+        if self.kind == '+':
+            return '+ {} = {} ( file: {}, line: {} )'.format(name,self.new,*self.new_src)
+        return '- {} = {} ( file: {}, line: {} )'.format(name,self.old,*self.old_src)
+
+    def __repr__(self):
+        return 'Change({!r}, {!r}, {!r}, {!r})'.format(self.kind,self.field,self.old,self.new)
+
+class IniDiff():
+    '''
+    Changes between two Ini objects, see :py:meth:`Ini.diff`. Iterating gives the
+    :py:class:`Change` records sorted by section and field, and ``str()`` a report with
+    one block per section.
+    '''
+    __slots__ = ['changes']
+
+    def __init__(self,changes:list):
+        self.changes = changes
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def __len__(self):
+        return len(self.changes)
+
+    @property
+    def added(self) -> list:
+        return [c for c in self.changes if c.kind=='+']
+
+    @property
+    def removed(self) -> list:
+        return [c for c in self.changes if c.kind=='-']
+
+    @property
+    def changed(self) -> list:
+        return [c for c in self.changes if c.kind=='~']
+
+    def sections(self) -> dict:
+        '''
+        ``{header: [Change]}`` of the sections with changes.
+        '''
+        out = {}
+        for c in self.changes:
+            out.setdefault(header_of(c.field),[]).append(c)
+        return out
+
+    def __str__(self):
+        out = []
+        for h,changes in self.sections().items():
+            out.append('[{}]'.format(h))
+            out += [str(c) for c in changes]
+        return '\n'.join(out)
+
+    def __repr__(self):
+        return 'IniDiff(+{}, -{}, ~{})'.format(len(self.added),len(self.removed),len(self.changed))
+
+#%% Snapshot
+# 快照文件：头 | 键表 | 哈希槽 | header 表 | header 成员 | 字符串 | 数组，数组按 8 字节对齐
+# 头：魔数、版本、键数、槽数、header 数、各段偏移、上下文 (偏移, 长度)、dtypes 的 JSON (偏移, 长度)
+_MAP_HEAD = struct.Struct('<8sIIIIQQQQQQQQQQ')
+_MAP_HEAD_V1 = struct.Struct('<8sIIIIQQQQQQQQ')    # 版本 1 没有 dtypes
+_MAP_KEY = struct.Struct('<QIQIQqQq')       # key, len, value, len, num vec, len, int vec, len
+_MAP_HEADER = struct.Struct('<QIII')        # name, len, first member, number of members
+
+def map_hash(b):
+    return zlib.crc32(b)
+
+def write_map(path,items,context='',dtypes=None):
+    '''
+    Write ``(key, value)`` pairs to a snapshot file for :py:class:`IniMap`. Values that
+    :py:func:`as_num_vec`/:py:func:`as_int_vec` turn into float/int arrays are also
+    stored as arrays. *dtypes* is the ``{pattern: dtype}`` table of :py:class:`Ini`.
+    '''
+    strings,arrays = io.BytesIO(),io.BytesIO()
+    def add_string(s):
+        b = s.encode()
+        off = strings.tell()
+        strings.write(b)
+        return off,len(b)
+    def add_array(v,conv,dtype):
+        try:
+            a = conv(v)
+        except Exception:
+            return 0,-1
+        if not isinstance(a,np.ndarray) or a.dtype!=dtype:
+            return 0,-1
+        off = arrays.tell()
+        arrays.write(a.astype('<'+a.dtype.char,copy=False).tobytes())
+        return off,len(a)
+    n = len(items)
+    recs,heads = [],{}
+    for i,(k,v) in enumerate(items):
+        recs.append(_MAP_KEY.pack(*add_string(k),*add_string(v),
+                                  *add_array(v,as_num_vec,np.float64),*add_array(v,as_int_vec,np.int64)))
+        heads.setdefault(header_of(k),[]).append(i)
+    nslots = 1<<max(3,(2*n).bit_length())
+    slots = [-1]*nslots
+    for i,(k,_) in enumerate(items):
+        h = map_hash(k.encode())
+        while slots[h&(nslots-1)]>=0:
+            h += 1
+        slots[h&(nslots-1)] = i
+    names = sorted(heads,key=lambda h:h.encode())
+    htab,members = [],[]
+    for h in names:
+        htab.append(_MAP_HEADER.pack(*add_string(h),len(members),len(heads[h])))
+        members += heads[h]
+    ctx = add_string(context)
+    dts = add_string(json.dumps(dtypes or {}))
+    parts = [b''.join(recs),np.array(slots,dtype='<i4').tobytes(),b''.join(htab),
+             np.array(members,dtype='<u4').tobytes(),strings.getvalue()]
+    offs,pos = [],_MAP_HEAD.size
+    for p in parts:
+        offs.append(pos)
+        pos += len(p)
+    pad = -pos%8
+    offs.append(pos+pad)
+    head = _MAP_HEAD.pack(MAP_MAGIC,2,n,nslots,len(names),*offs,*ctx,*dts)
+    tmp = '{}.{}.tmp'.format(path,os.getpid())
+    with open(tmp,'wb') as f:
+        f.write(head)
+        for p in parts:
+            f.write(p)
+        f.write(b'\0'*pad)
+        f.write(arrays.getvalue())
+    os.replace(tmp,path)
+
+class MapStore(Mapping):
+    '''
+    Read-only key store over a snapshot mapped in memory. Only the header is read on
+    open; keys are found through the hash slots of the file.
+    '''
+    def __init__(self,path:str):
+        with open(path,'rb') as f:
+            self.buf = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        head = _MAP_HEAD_V1.unpack_from(self.buf)
+        if head[0]!=MAP_MAGIC:
+            raise INIFormatError('Not an Ini snapshot ( file: {}, line: 0 ).'.format(path))
+        self._dts = None
+        if head[1]>=2:
+            head = _MAP_HEAD.unpack_from(self.buf)
+            self._dts = head[-2:]
+        _,_,self.n,nslots,self.nheads,self._keys,o_slots,self._heads,o_members,self._str,self._arr,ctx,ctx_len = head[:13]
+        view = memoryview(self.buf)
+        self.slots = view[o_slots:o_slots+4*nslots].cast('i')
+        self.members = view[o_members:o_members+4*self.n].cast('I')
+        self._mask = nslots-1
+        self._ctx = ctx,ctx_len
+        self._values = {}       # key -> decoded value
+        self._names = None      # encoded header names, for bisect
+
+    def _string(self,off,n):
+        off += self._str
+        return self.buf[off:off+n].decode()
+
+    def _rec(self,i):
+        return _MAP_KEY.unpack_from(self.buf,self._keys+i*_MAP_KEY.size)
+
+    def index(self,k) -> int:
+        '''
+        Index of *k* in the key table, -1 if absent.
+        '''
+        b = k.encode()
+        h,slots,buf,n = map_hash(b),self.slots,self.buf,len(b)
+        while True:
+            i = slots[h&self._mask]
+            if i<0:
+                return -1
+            off,klen = _MAP_KEY.unpack_from(buf,self._keys+i*_MAP_KEY.size)[:2]
+            if klen==n and buf[self._str+off:self._str+off+n]==b:
+                return i
+            h += 1
+
+    def __getitem__(self,k):
+        try:
+            return self._values[k]
+        except KeyError:
+            pass
+        i = self.index(k) if isinstance(k,str) else -1
+        if i<0:
+            raise KeyError(k)
+        v = self._values[k] = self._string(*self._rec(i)[2:4])
+        return v
+
+    def __contains__(self,k):
+        return k in self._values or (isinstance(k,str) and self.index(k)>=0)
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self._string(*self._rec(i)[:2])
+
+    def __len__(self):
+        return self.n
+
+    raw = __getitem__
+    has_raw = __contains__
+
+    def array(self,k,integer:bool=False):
+        '''
+        Stored :py:func:`as_int_vec` (if *integer*) or :py:func:`as_num_vec` array of *k*,
+        read-only and backed by the file, or None.
+        '''
+        i = self.index(k)
+        if i<0:
+            return None
+        rec = self._rec(i)
+        off,n = rec[6:8] if integer else rec[4:6]
+        if n<0:
+            return None
+        return np.frombuffer(self.buf,'<i8' if integer else '<f8',n,self._arr+off)
+
+    def context(self) -> str:
+        return self._string(*self._ctx)
+
+    def dtypes(self) -> dict:
+        '''
+        ``{pattern: dtype}`` table of the exported object, empty for version 1 files.
+        '''
+        return {} if self._dts is None else json.loads(self._string(*self._dts))
+
+    def _header(self,j):
+        return _MAP_HEADER.unpack_from(self.buf,self._heads+j*_MAP_HEADER.size)
+
+    def headers(self) -> list:
+        return [self._string(*self._header(j)[:2]) for j in range(self.nheads)]
+
+    def section(self,header:str) -> list:
+        if self._names is None:
+            self._names = [h.encode() for h in self.headers()]
+        b = header.encode()
+        j = bisect.bisect_left(self._names,b)
+        if j==len(self._names) or self._names[j]!=b:
+            return []
+        _,_,start,count = self._header(j)
+        return [self._string(*self._rec(i)[:2]) for i in self.members[start:start+count]]
+
+class IniMap(Ini):
+    '''
+    Read-only Ini over a snapshot written by :py:meth:`Ini.export`. Opening it maps the
+    file without reading the values, so many processes share its pages, and every
+    ``find*``/``get*`` accessor gives the same results as on the exported object.
+    Vectors are served from the arrays pre-parsed in the file.
+    '''
+    __slots__ = ['path']
+
+    def __init__(self,path:str,memo_size:int=1024):
+        '''
+        Parameters
+        ----------
+        path : str
+            Snapshot file written by :py:meth:`Ini.export`.
+        memo_size : int, optional (default=1024)
+            See :py:class:`Ini`.
+        '''
+        self.path = path
+        self.d = MapStore(path)
+        self.fini = self.d.get('PATH_FINI',path)
+        self.cache_dir = None
+        self.lazy = False
+        self.memo_size = memo_size
+        self.header = None
+        self._memo = OrderedDict()
+        self._src,self._files = {},{}
+        self._callbacks,self._watcher = [],None
+        self._context = None
+        self._trace = None
+        self._digest = None
+        self.dtypes = self.d.dtypes()
+
+    @property
+    def lines(self):
+        return self.context.split('\n')
+
+    @property
+    def context(self):
+        if self._context is None:
+            self._context = self.d.context()
+        return self._context
+
+    def _typed(self,field:str,kwargs:dict,conv):
+        dtype = getattr(conv,'dtype',None)
+        if not kwargs and (conv is as_num_vec or conv is as_int_vec or dtype in ['float64','int64']):
+            a = self.d.array(field.upper(),conv is as_int_vec or dtype=='int64')
+            if a is not None:
+                return a
+        return Ini._typed(self,field,kwargs,conv)
+
+    def set(self,field:str,val):
+        raise TypeError('IniMap is read-only ( file: {} ).'.format(self.path))
+
+    def update(self,values:dict):
+        raise TypeError('IniMap is read-only ( file: {} ).'.format(self.path))
+
+    def reload(self,force:bool=False):
+        return set()
+
+    def _reparse(self,changed):
+        raise TypeError('IniMap has no files to parse again ( file: {} ).'.format(self.path))
+
+    def _origin(self,k):
+        return (self.path,0)
+
+    def export(self,path:str):
+        write_map(path,[(k,self.d[k]) for k in self.d],self.context,self.dtypes)
+
+    def __getstate__(self):
+        return {'path':self.path,'memo_size':self.memo_size}
+
+    def __setstate__(self,state):
+        self.__init__(**state)
+
+#%% Shared files
+class FileCache():
+    '''
+    Files read by several Ini objects, with their lines tokenized and their literal
+    commands scanned once, reused as long as the file is unchanged (see
+    :py:func:`same_file`). Thread-safe.
+    '''
+    def __init__(self):
+        self._files = {}    # path -> (signature, lines, tokens, commands)
+        self._lock = threading.Lock()
+
+    def get(self,path:str) -> tuple:
+        '''
+        ``(signature, lines, tokens, commands)`` of *path*, see :py:func:`read_file`,
+        :py:func:`tokenize` and :py:func:`scan_commands`.
+        '''
+        entry = self._files.get(path)
+        if entry is not None and same_file(path,entry[0]):
+            return entry
+        sig,lines = read_file(path)
+        entry = (sig,lines,tokenize(lines),scan_commands(lines))
+        with self._lock:
+            self._files[path] = entry
+        return entry
+
+    def __len__(self):
+        return len(self._files)
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self,state):
+        self.__init__()
+
+_FILE_CACHE = FileCache()   # of this process, for load_shared
+
+def load_shared(cls,fini,kwargs):
+    '''
+    ``cls(fini, **kwargs)`` with the file cache of the process, for the process pool of
+    :py:meth:`Ini.load_many`.
+    '''
+    return cls(fini,file_cache=_FILE_CACHE,**kwargs)
+
+#%% Tracing
+class Tracer():
+    '''
+    Tree of timed spans of a parse. Spans of the parsing thread nest through
+    :py:meth:`begin`/:py:meth:`end`; spans of other threads (commands) are added under
+    the root with :py:meth:`add`.
+    '''
+    def __init__(self):
+        self.t0 = time.perf_counter()
+        self.root = None
+        self._stack = []
+        self._lock = threading.Lock()
+
+    def _span(self,name,cat,start,args):
+        return {'name':name,'cat':cat,'start':start-self.t0,'dur':None,
+                'tid':threading.get_ident(),'args':args,'children':[]}
+
+    def begin(self,name:str,cat:str,**args):
+        span = self._span(name,cat,time.perf_counter(),args)
+        if self._stack:
+            self._stack[-1]['children'].append(span)
+        elif self.root is None:
+            self.root = span
+        self._stack.append(span)
+
+    def end(self,**args):
+        span = self._stack.pop()
+        span['dur'] = time.perf_counter()-self.t0-span['start']
+        span['args'].update(args)
+
+    def add(self,name:str,cat:str,start:float,**args):
+        span = self._span(name,cat,start,args)
+        span['dur'] = time.perf_counter()-start
+        with self._lock:
+            self.root['children'].append(span)
+
+    def spans(self):
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            span = stack.pop()
+            yield span
+            stack.extend(span['children'])
+
+    def stats(self) -> dict:
+        out = dict.fromkeys(['files','lines','bytes','max_depth','missing_includes',
+                             'commands','commands_run','command_bytes'],0)
+        out.update(dict.fromkeys(['time','read_time','wait_time','command_time','resolve_time'],0.))
+        for span in self.spans():
+            cat,args,dur = span['cat'],span['args'],span['dur'] or 0.
+            if cat=='file':
+                out['files'] += 1
+                out['lines'] += args.get('lines',0)
+                out['max_depth'] = max(out['max_depth'],args['depth'])
+            elif cat=='io':
+                out['bytes'] += args.get('bytes',0)
+                out['read_time'] += dur
+            elif cat=='wait':
+                out['missing_includes'] += 1
+                out['wait_time'] += dur
+            elif cat=='command':
+                out['commands'] += 1
+                out['commands_run'] += args['ran']
+                out['command_bytes'] += args['bytes'] or 0
+                out['command_time'] += dur
+            elif cat=='resolve':
+                out['resolve_time'] += dur
+        out['time'] = self.root['dur'] if self.root is not None else 0.
+        out['spans'] = self.root
+        return out
+
+    def chrome(self) -> dict:
+        '''
+        Spans in the Trace Event format, times in microseconds.
+        '''
+        pid = os.getpid()
+        events = [{'name':s['name'],'cat':s['cat'],'ph':'X','pid':pid,'tid':s['tid'],
+                   'ts':s['start']*1e6,'dur':(s['dur'] or 0.)*1e6,'args':s['args']}
+                  for s in self.spans()]
+        return {'traceEvents':sorted(events,key=lambda e:e['ts']),'displayTimeUnit':'ms'}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+#%% Shell commands
+class CommandRunner():
+    '''
+    Runner of the ``$(...)`` commands of one parse.
+
+    Commands are run in a bounded thread pool, each distinct command only once, and the
+    output is the same as ``subprocess.getoutput``. Outputs may be shared across processes
+    through an on-disk cache. After :py:meth:`close`, until :py:meth:`open`, commands run
+    in the calling thread, e.g. those resolved on access in lazy mode.
+    '''
+    def __init__(self,workers:int=8,timeout:float=None,deadline:float=None,
+                 cache_dir:str=None,ttl:Union[float,dict]=60):
+        '''
+        Parameters
+        ----------
+        workers : int, optional (default=8)
+            Maximum number of commands running at the same time.
+        timeout : float, optional (default=None)
+            Timeout in seconds of each command.
+        deadline : float, optional (default=None)
+            Deadline in seconds, counted from now, for all commands together.
+        cache_dir : str, optional (default=None)
+            Directory of the command result cache, keyed by the command and the working
+            directory.
+        ttl : float or dict, optional (default=60)
+            Time to live in seconds of cached outputs, or a dict of ``{command: ttl}`` whose
+            ``'*'`` entry is the default.
+        '''
+        self.workers = workers
+        self.timeout = timeout
+        self.deadline = None if deadline is None else time.monotonic()+deadline
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._futures = {}
+        self._where = {}
+        self._procs = set()
+        self._killed = set()    # processes killed by close()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._open = True       # False after close(): run in the calling thread
+        self._local = threading.local()
+        self.trace = None       # Tracer, given by Ini
+
+    def submit(self,cmd:str,where:tuple=None,cache:bool=True):
+        '''
+        Start *cmd* if it is not started yet. *where* is the ``(file, line)`` reported in errors.
+        If *cache* is False, the on-disk cache is bypassed.
+        '''
+        key = (cmd,cache and self.cache_dir is not None)
+        with self._lock:
+            fut = self._futures.get(key)
+            if fut is not None:
+                return fut
+            self._where.setdefault(cmd,where)
+            if self._open:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(self.workers,thread_name_prefix='ini-cmd')
+                fut = self._futures[key] = self._pool.submit(self._run,*key)
+                return fut
+        # 关闭后不再起线程池，在调用线程里执行；其它线程等同一个 future
+            fut = self._futures[key] = Future()
+        try:
+            fut.set_result(self._run(*key))
+        except Exception as e:
+            fut.set_exception(e)
+        except BaseException:
+            self._drop(key,fut)
+            fut.cancel()
+            raise
+        return fut
+
+    def result(self,cmd:str,where:tuple=None,cache:bool=True) -> str:
+        '''
+        Return the output of *cmd*, starting it if needed.
+        '''
+        fut = self.submit(cmd,where,cache)
+        try:
+            return fut.result(self._remaining())
+        except FutureTimeoutError:
+            self.close()
+            raise INICommandError(self._message(cmd,'missed the deadline'))
+        except CommandTimeout:
+            raise INICommandError(self._message(cmd,'timed out after {}s'.format(self.timeout)))
+        except (CommandKilled,CancelledError):
+        # 被 close() 杀掉或取消的命令没有结果，丢掉后重新执行
+            self._drop((cmd,cache and self.cache_dir is not None),fut)
+            return self.result(cmd,where,cache)
+
+    def open(self,deadline:float=None):
+        '''
+        Run commands in the pool again, until the next :py:meth:`close`, with a new
+        *deadline* in seconds counted from now.
+        '''
+        self.deadline = None if deadline is None else time.monotonic()+deadline
+        self._open = True
+
+    def close(self):
+        '''
+        Kill running commands and release the pool. Commands killed or cancelled here are
+        run again by a later :py:meth:`result`, in the calling thread.
+        '''
+        with self._lock:
+            procs = list(self._procs)
+            self._killed.update(procs)
+            pool,self._pool = self._pool,None
+            self._open = False
+        # 未完成的结果都作废
+            self._futures = {k:f for k,f in self._futures.items() if f.done() and not f.cancelled()}
+        for p in procs:
+            kill(p)
+        if pool is not None:
+            pool.shutdown(wait=False,cancel_futures=True)
+
+    def _drop(self,key,fut):
+        with self._lock:
+            if self._futures.get(key) is fut:
+                del self._futures[key]
+
+    def __getstate__(self):
+    # 只保存设置，进程、线程池和结果不保存
+        return {k:getattr(self,k) for k in ['workers','timeout','cache_dir','ttl']}
+
+    def __setstate__(self,state):
+        self.__init__(**state)
+        self._open = False
+
+    def _remaining(self):
+        return None if self.deadline is None else max(self.deadline-time.monotonic(),0)
+
+    def _message(self,cmd,what):
+        where = self._where.get(cmd) or ('?','?')
+        return 'Command \'{}\' {} ( file: {}, line: {} ).'.format(cmd,what,*where)
+
+    def _timeout(self):
+        timeout = self._remaining()
+        if self.timeout is not None:
+            timeout = self.timeout if timeout is None else min(timeout,self.timeout)
+        return timeout
+
+    def _run(self,cmd,cache):
+        if self.trace is None:
+            return self._fetch(cmd,cache)
+        start = time.perf_counter()
+        self._local.ran = False
+        out,error = None,None
+        try:
+            out = self._fetch(cmd,cache)
+            return out
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            where = self._where.get(cmd) or ('?','?')
+            self.trace.add('command','command',start,cmd=cmd,file=where[0],line=where[1],
+                           ran=self._local.ran,bytes=None if out is None else len(out),error=error)
+
+    def _fetch(self,cmd,cache):
+        ttl = self.ttl.get(cmd,self.ttl.get('*',60)) if isinstance(self.ttl,dict) else self.ttl
+        if not cache or not ttl:
+            return self._exec(cmd)
+    # 同一时间只有一个进程执行同一个命令，其它进程等待后读缓存
+        cwd = os.getcwd()
+        name = hashlib.sha1('{}\0{}'.format(cmd,cwd).encode()).hexdigest()
+        path = os.path.join(self.cache_dir,'{}.pkl'.format(name))
+    # 缓存目录不可用时不影响解析，警告后直接执行
+        try:
+            os.makedirs(self.cache_dir,exist_ok=True)
+            lock = open(path+'.lock','a')
+        except OSError as e:
+            print('Warning: cannot use command cache {} ({}).'.format(self.cache_dir,e))
+            return self._exec(cmd)
+        with lock:
+            try:
+                locked = flock(lock,self._timeout())
+            except OSError as e:
+                print('Warning: cannot lock command cache {} ({}).'.format(path,e))
+                return self._exec(cmd)
+            if not locked:
+                raise CommandTimeout(cmd)
+            try:
+                with open(path,'rb') as f:
+                    entry = pickle.load(f)
+                if entry['cmd']==cmd and entry['cwd']==cwd and entry['expires']>time.time():
+                    return entry['out']
+            except Exception:
+                pass
+            out = self._exec(cmd)
+        # 只缓存自己结束的命令，被信号杀掉的输出不完整
+            if not self._local.exited:
+                return out
+            now = time.time()
+            entry = {'cmd':cmd,'cwd':cwd,'out':out,'time':now,'expires':now+ttl}
+            tmp = '{}.{}.tmp'.format(path,os.getpid())
+            try:
+                with open(tmp,'wb') as f:
+                    pickle.dump(entry,f,protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp,path)
+            except OSError as e:
+                print('Warning: cannot write command cache {} ({}).'.format(path,e))
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+            return out
+
+    def _exec(self,cmd):
+        self._local.ran = True
+        timeout = self._timeout()
+        proc = subprocess.Popen(cmd,shell=True,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,
+                                text=True,start_new_session=True)
+        with self._lock:
+            self._procs.add(proc)
+        try:
+            out,_ = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            kill(proc)
+            proc.communicate()
+            raise CommandTimeout(cmd)
+        finally:
+            with self._lock:
+                self._procs.discard(proc)
+                killed = proc in self._killed
+                self._killed.discard(proc)
+        if killed:
+            raise CommandKilled(cmd)
+        self._local.exited = proc.returncode>=0
+        if out[-1:]=='\n':
+            out = out[:-1]
+        return out
+
+class AsyncCommandRunner(CommandRunner):
+    '''
+    :py:class:`CommandRunner` running the commands with ``asyncio.create_subprocess_shell``
+    on *loop*, from its worker threads, for :py:meth:`Ini.aload`. Without a loop it runs
+    them like :py:class:`CommandRunner`.
+    '''
+    def __init__(self,*args,loop:'asyncio.AbstractEventLoop'=None,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.loop = loop
+
+    def _exec(self,cmd):
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return super()._exec(cmd)
+        self._local.ran = True
+        out,code = asyncio.run_coroutine_threadsafe(self._aexec(cmd,self._timeout()),loop).result()
+        self._local.exited = code>=0
+        return out
+
+    async def _aexec(self,cmd,timeout):
+        proc = await asyncio.create_subprocess_shell(cmd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,
+                                                     start_new_session=True)
+        with self._lock:
+            self._procs.add(proc)
+        try:
+            out,_ = await asyncio.wait_for(proc.communicate(),timeout)
+        except asyncio.TimeoutError:
+            kill(proc)
+            await proc.wait()
+            raise CommandTimeout(cmd)
+        finally:
+            with self._lock:
+                self._procs.discard(proc)
+                killed = proc in self._killed
+                self._killed.discard(proc)
+        if killed:
+            raise CommandKilled(cmd)
+    # 与 text=True 一样的解码和换行
+        out = io.TextIOWrapper(io.BytesIO(out)).read()
+        if out[-1:]=='\n':
+            out = out[:-1]
+        return out,proc.returncode
 
  #%% Self-defined Exceptions
     
 class INIFormatError(Exception):
     pass
 
+class INICommandError(Exception):
+    pass
+
+class INIRefError(INIFormatError,KeyError):
+    __str__ = Exception.__str__
+
+class INITemplateError(INIFormatError,KeyError):
+    '''
+    ``$name$`` placeholders left without a value by :py:meth:`Ini.render`, in *missing*.
+    '''
+    def __init__(self,msg,missing):
+        super().__init__(msg)
+        self.missing = missing
+
+    __str__ = Exception.__str__
+
+class INIExtractError(Exception):
+    '''
+    Errors of :py:meth:`Ini.extract`, ``{field: message}`` in *errors*.
+    '''
+    def __init__(self,errors:dict):
+        self.errors = errors
+        lines = ['  {} : {}'.format(k,v) for k,v in errors.items()]
+        super().__init__('\n'.join(['{} field(s) cannot be extracted:'.format(len(errors))]+lines))
+
+class CommandTimeout(Exception):
+    pass
+
+class CommandKilled(Exception):
+    pass
+
+#%% Query daemon
+class IniServer():
+    '''
+    Local daemon keeping parsed Ini objects in memory and answering ``find*``/``get*``
+    queries over a Unix socket, see :py:func:`query` and ``python -m ini serve``.
+
+    Objects are kept by file and working directory of the client, and parsed again, in the
+    environment of the client, when one of their files changed, the day changed or an
+    environment variable they read changed. ``$(...)`` outputs are kept until then, as
+    with :py:meth:`reload <Ini.reload>`. Queries are answered one at a time.
+    '''
+    def __init__(self,path:str=None,max_configs:int=256,**kwargs):
+        '''
+        Parameters
+        ----------
+        path : str, optional (default=None)
+            Socket path, see :py:func:`default_socket`.
+        max_configs : int, optional (default=256)
+            Number of objects kept, least recently used first out.
+        **kwargs
+            Arguments of :py:class:`Ini`.
+        '''
+        self.path = default_socket() if path is None else path
+        self.max_configs = max_configs
+        self.kwargs = kwargs
+        self._inis = OrderedDict()      # (fini, cwd) -> (Ini, environment of the parse)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def serve_forever(self,poll:float=0.5):
+        '''
+        Listen until :py:meth:`shutdown <IniServer.shutdown>` or a ``stop`` request.
+        '''
+        sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(self.path)
+                raise OSError('A daemon is already listening on {}.'.format(self.path))
+            except (ConnectionRefusedError,FileNotFoundError):
+                pass
+            sock.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            sock = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+            mask = os.umask(0o177)
+            try:
+                sock.bind(self.path)
+            finally:
+                os.umask(mask)
+            sock.listen(64)
+            sock.settimeout(poll)
+            while not self._stop.is_set():
+                try:
+                    conn,_ = sock.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                threading.Thread(target=self._handle,args=(conn,),name='ini-serve',daemon=True).start()
+        finally:
+            sock.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def shutdown(self):
+        self._stop.set()
+
+    def query(self,fini:str,cwd:str,env:dict,queries:list) -> list:
+        '''
+        Answers of *queries* ``[[method, field, *args]]`` on *fini* in the working directory
+        *cwd* and the environment *env* (raw ``os.environ``).
+        '''
+        with self._lock:
+            return run_queries(self._ini(os.path.join(cwd,fini),cwd,env),queries)
+
+    def _ini(self,fini,cwd,env):
+        key = (fini,cwd)
+        hit = self._inis.get(key)
+        if hit is not None:
+            o,used = hit
+            if o.changed_files() or o._builtin['TODAY']!=dm.datetime.today().strftime('%Y%m%d'):
+                hit = None
+            elif used!=env:
+                view = env_view(env)
+                if env_matches(o._env_used,view):
+                # 读到的环境变量都没变，只换环境变量层
+                    o.env = o.d.env = view
+                    o.d.reindex()
+                    o._memo = OrderedDict()
+                    o._digest = None
+                    self._inis[key] = (o,env)
+                else:
+                    hit = None
+        if hit is None:
+            o = self._parse(fini,cwd,env)
+            self._inis[key] = (o,env)
+            while len(self._inis) > self.max_configs:
+                self._inis.popitem(last=False)
+        self._inis.move_to_end(key)
+        return o
+
+    def _parse(self,fini,cwd,env):
+    # 在客户端的环境变量和目录下解析，命令也在其中执行
+        old,here = dict(os.environ),os.getcwd()
+        try:
+            os.environ.clear()
+            os.environ.update(env)
+            os.chdir(cwd)
+            return Ini(fini,**self.kwargs)
+        finally:
+            os.environ.clear()
+            os.environ.update(old)
+            os.chdir(here)
+
+    def _handle(self,conn):
+        with conn,conn.makefile('rb') as r,conn.makefile('wb') as w:
+            for line in r:
+                try:
+                    req = json.loads(line)
+                    if req.get('stop'):
+                        self.shutdown()
+                        reply = {'values':[]}
+                    else:
+                        reply = {'values':self.query(req['fini'],req['cwd'],req['env'],req['queries'])}
+                except Exception as e:
+                    msg = e.args[0] if isinstance(e,KeyError) and e.args else str(e)
+                    reply = {'error':msg,'type':type(e).__name__}
+                w.write(json.dumps(reply).encode()+b'\n')
+                w.flush()
+
 #%% Functions
 def file2list(file_):
     with open(file_,'r') as f:
         lines = [l.strip('\n') for l in f.readlines()]
     return lines
 
+def read_file(file_):
+    '''
+    Return ``(signature, lines)`` of a file, reading it only once. The signature is
+    ``(mtime_ns, size, sha1)``, with the stat taken before reading.
+    '''
+    st = os.stat(file_)
+    with open(file_,'rb') as f:
+        data = f.read()
+    lines = [l.strip('\n') for l in io.TextIOWrapper(io.BytesIO(data)).readlines()]
+    return (st.st_mtime_ns,st.st_size,hashlib.sha1(data).hexdigest()),lines
+
+def file_signature(file_):
+    st = os.stat(file_)
+    with open(file_,'rb') as f:
+        sha = hashlib.sha1(f.read()).hexdigest()
+    return st.st_mtime_ns,st.st_size,sha
+
+def same_file(file_,sig):
+    '''
+    Check a file against a signature from :py:func:`file_signature`. The content is only
+    hashed again if mtime or size differ.
+    '''
+    if sig is None:
+        return not os.path.exists(file_)
+    try:
+        st = os.stat(file_)
+    except OSError:
+        return False
+    if (st.st_mtime_ns,st.st_size)==sig[:2]:
+        return True
+    return st.st_size==sig[1] and file_signature(file_)[2]==sig[2]
+
+def marked_env(env):
+    '''
+    Digest of the environment variables whose values contain ``%`` or ``$(``, which are
+    the only ones changed by a final replacement pass over all keys.
+    '''
+    items = sorted((k,v) for k,v in env.items() if '%' in v or '$(' in v)
+    return {'*':hashlib.sha1(repr(items).encode()).hexdigest()}
+
 parse_pattern = lambda s,pattern: re.findall(re.compile(pattern),s)
 
-def push(fini,stack_dir,stack_fini,stack_ptr):
-    if stack_dir:
-        fini = os.path.join(stack_dir[-1],fini)
+def classify_line(s):
+    '''
+    Classify one (comment-stripped) line of an ini file.
+
+    Equivalent to trying the patterns of ``PATT`` in order and returning the first
+    ``(type_, re.findall(...))`` that matches, or ``(None, None)``. Only the patterns
+    that can possibly match are tried, chosen by the first character of the line and
+    the assignment operator (``=``, ``|=`` or ``$=``).
+    '''
+    c = s[:1]
+    if not c or c.isspace():
+        cands = ('empty',)
+    elif c == '[':
+        cands = ('header',)
     else:
-        fini = os.path.abspath(fini)
-    stack_dir.append(os.path.dirname(os.path.abspath(fini)))
-    stack_fini.append(fini)
-    stack_ptr.append(0)
-    return fini
+        m = _pOp.match(s)
+        if m is not None:
+            cands = _DISPATCH[m.group(1) or '']
+        else:
+            cands = ()
+        if c == 'i' and s.startswith('include'):
+            cands = ('include','include_opt') + cands
+    for key in cands + _TAIL:
+        content = _PATT[key].findall(s)
+        if content: return key,content
+    return None,None
+
+def tokenize(lines):
+    '''
+    ``(line, type_, val)`` of each line of a file, with the comment stripped from *line*
+    and ``(type_, val)`` from :py:func:`classify_line`, or None for lines left empty.
+    '''
+    out = []
+    for l in lines:
+        l = l.partition('#')[0]
+        out.append((l,)+classify_line(l) if l else None)
+    return out
+
+def expand_tree(node,out=None):
+    '''
+    Lines of an include tree node ``[file, lines, {index: (name, child)}, tokens]``, includes
+    expanded. The source may be packed, see :py:func:`pack_source`; dropped lines (None) are
+    read again from the file.
+    '''
+    out = [] if out is None else out
+    f,lines,incs,_ = node
+    if lines is None:
+        lines = read_file(f)[1]
+    elif isinstance(lines,bytes):
+        lines = unpack_source(node)[0]
+    for i,l in enumerate(lines):
+        inc = incs.get(i)
+        if inc is None:
+            out.append(l)
+        else:
+            name,child = inc
+            out.append('# START include <{}>'.format(name))
+            expand_tree(child,out)
+            out.append('# END include <{}>'.format(name))
+    return out
+
+def pack_tree(node,keep_lines:bool=False):
+    '''
+    Replace the tokens of every node of an include tree with the compressed lines and
+    tokens, see :py:func:`pack_source`, and the lines too unless *keep_lines*.
+    '''
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node[3],list):
+            node[3] = pack_source(node[1],node[3])
+            if not keep_lines:
+                node[1] = node[3]
+        stack.extend(child for _,child in node[2].values())
+
+def pack_source(lines,toks):
+    '''
+    Lines of a file and their tokens, pickled and compressed with zlib, a few times smaller
+    than the lists. Tokens share their strings with the lines, so they add little.
+    '''
+    return zlib.compress(pickle.dumps((lines,toks),protocol=pickle.HIGHEST_PROTOCOL),1)
+
+def unpack_source(node):
+    '''
+    ``(lines, tokens)`` of an include tree node, see :py:func:`pack_source`.
+    '''
+    if isinstance(node[3],bytes):
+        return pickle.loads(zlib.decompress(node[3]))
+    return node[1],node[3]
+
+def tree_files(node):
+    '''
+    ``(file, lines, tokens)`` of every node of an include tree, unpacked, lines None if
+    dropped.
+    '''
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        lines,toks = unpack_source(node)
+        yield node[0],lines,toks
+        stack.extend(child for _,child in node[2].values())
+
+_ENV = [None,None,None]
 
-def pop(stack_dir,stack_fini,stack_ptr):
-    stack_dir.pop()
-    stack_fini.pop()
-    stack_ptr.pop()
+def environ() -> Mapping:
+    '''
+    Read-only view of the environment variables, keys upper-cased and ``'__'`` replaced by
+    ``'~'``. It is shared by all Ini objects and rebuilt only when the environment changed.
+    '''
+    raw = getattr(os.environ,'_data',None)
+    if raw is None:
+        raw = dict(os.environ)
+    if _ENV[0]!=raw:
+        _ENV[:] = [dict(raw),env_view(os.environ),None]
+    return _ENV[1]
+
+def env_view(raw:Mapping) -> Mapping:
+    '''
+    Read-only view of the environment variables *raw* as the Ini objects see them.
+    '''
+    # 在命令行设定环境变量时，用'__'代替'~'
+    return MappingProxyType({k.upper().replace('__','~'):v for k,v in raw.items()})
+
+def env_matches(used:dict,env:Mapping) -> bool:
+    '''
+    Whether *env* gives the values recorded in *used* (``Ini._env_used``) by a parse.
+    '''
+    for k,v in used.items():
+        if k=='*':
+            if v!=marked_env(env)['*']: return False
+        elif env.get(k)!=v:
+            return False
+    return True
+
+def get_slots(obj):
+    '''
+    ``{name: value}`` of the slots set on *obj*, and of its ``__dict__`` if any.
+    '''
+    state = {}
+    for cls in type(obj).__mro__:
+        for k in cls.__dict__.get('__slots__',()):
+            if k!='__weakref__' and hasattr(obj,k):
+                state[k] = getattr(obj,k)
+    state.update(getattr(obj,'__dict__',{}))
+    return state
+
+def set_slots(obj,state):
+    for k,v in state.items():
+        setattr(obj,k,v)
+
+def header_of(field):
+    return field.rpartition('~')[0]
+
+def index_headers(d):
+    '''
+    ``{header: {field: None}}`` of the fields in *d*.
+    '''
+    idx = {}
+    for k in d:
+        idx.setdefault(header_of(k),{})[k] = None
+    return idx
+
+def env_index(env):
+    '''
+    Header index of *env*, shared while it is the current :py:func:`environ`.
+    '''
+    if env is not _ENV[1]:
+        return index_headers(env)
+    if _ENV[2] is None:
+        _ENV[2] = index_headers(env)
+    return _ENV[2]
+
+def scan_commands(lines):
+    '''
+    Return ``(command, line index, key)`` of the ``$(...)`` commands in *lines* that do not depend
+    on any ``%..%`` reference, i.e. exactly the commands the parse is going to run for them.
+    Values of ``|=`` keys are skipped since they may come from the environment.
+    '''
+    if not any('$(' in l for l in lines):
+        return []
+    out = []
+    vec,start = None,0
+    for i,l in enumerate(lines):
+        l = l.partition('#')[0]
+        if not l: continue
+        type_,val = classify_line(l)
+        if type_ in ['scala','scala_last','vec','vec_start']:
+            k,v = val[0]
+            if type_=='scala':
+                out.append((v,i,k))
+            elif type_=='vec_start':
+                vec,start,key = [rep_blanks(v)],i,k
+            else:
+                out.append((rep_blanks(v),i,k))
+        elif type_ in ['vec_mid','vec_end'] and vec is not None:
+            vec.append(rep_blanks(val[0]))
+            if type_=='vec_end':
+                out.append((' '.join(vec),start,key))
+                vec = None
+        elif type_ not in ['empty','vec_mid']:
+            vec = None
+    return [(c,i,k) for v,i,k in out if '%' not in v for c in _pCmd.findall(v)]
+
+def flock(f,timeout=None):
+    '''
+    Take an exclusive lock on file object *f*, released when it is closed. Return False if
+    the lock cannot be taken within *timeout* seconds.
+    '''
+    if timeout is None:
+        fcntl.flock(f,fcntl.LOCK_EX)
+        return True
+    end = time.monotonic()+timeout
+    while True:
+        try:
+            fcntl.flock(f,fcntl.LOCK_EX|fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.monotonic()>=end:
+                return False
+            time.sleep(0.01)
+
+def kill(proc):
+    try:
+        os.killpg(proc.pid,signal.SIGKILL)
+    except OSError:
+        pass
 
 def rep_blanks(s):
-    return re.sub('\s+',' ',s).strip(' ')
+# 只有单个空格时不用正则：isprintable() 对 ' ' 以外的空白都为 False
+    if s.isprintable() and '  ' not in s:
+        return s.strip(' ')
+    return _pBlanks.sub(' ',s).strip(' ')
+
+class Template():
+    '''
+    ``$name$`` template split into literals and placeholder names, so that
+    ``lits[0] + v(names[0]) + lits[1] + ... + lits[-1]`` renders it. *gaps* are the
+    literals between two placeholders that are names themselves, as in ``'$a$_$b$'``,
+    and must not be substituted.
+    '''
+    __slots__ = ['lits','names','gaps','fmt']
+
+    def __init__(self,lits,names,gaps):
+        self.lits = lits
+        self.names = names
+        self.gaps = gaps
+        self.fmt = '%s'.join(l.replace('%','%%') for l in lits)
+
+@functools.lru_cache(maxsize=4096)
+def compile_template(s):
+    '''
+    :py:class:`Template` of *s*, or None if its ``$`` cannot be split unambiguously, e.g.
+    ``'$a$b$'``, in which case :py:func:`replace` substitutes sequentially.
+    '''
+    lits,names,pos = [],[],0
+    for m in _pRep.finditer(s):
+        lit = s[pos:m.start()]
+        if '$' in lit:
+            return None
+        lits.append(lit)
+        names.append(m.group(1))
+        pos = m.end()
+    if '$' in s[pos:]:
+        return None
+    lits.append(s[pos:])
+    gaps = frozenset(l for l in lits[1:-1] if _pWord.fullmatch(l))
+    return Template(tuple(lits),tuple(names),gaps)
 
 def replace(s,**kwargs):
+    if not kwargs or '$' not in s:
+        return s
+    t = compile_template(s)
+    if t is not None and t.gaps.isdisjoint(kwargs):
+        vals = []
+        for name in t.names:
+            v = kwargs.get(name)
+            if v is None:
+                vals.append('$'+name+'$')
+                continue
+            v = str(v)
+            if '$' in v:
+                break
+            vals.append(v)
+        else:
+            return t.fmt % tuple(vals)
+    # 有歧义时按顺序逐个替换
     for k,v in kwargs.items():
         if v is not None:
             s = s.replace('${}$'.format(k),str(v))
     return s
 
+def param_columns(params,names):
+    '''
+    ``(n, {name: values})`` of kwargs given as a list of dicts, a dict of equal-length
+    columns (strings and scalars are repeated) or a numpy structured array.
+    '''
+    if isinstance(params,np.ndarray) and params.dtype.names:
+        params = {k:params[k] for k in params.dtype.names}
+    if not isinstance(params,Mapping):
+        rows = list(params)
+        return len(rows),{k:[row.get(k) for row in rows] for k in names}
+    cols = {k:v for k,v in params.items()
+                if hasattr(v,'__len__') and not isinstance(v,(str,bytes)) and getattr(v,'ndim',1)>0}
+    n = {len(v) for v in cols.values()}
+    if len(n)>1:
+        raise ValueError('Columns of different lengths: {}.'.format({k:len(v) for k,v in cols.items()}))
+    n = n.pop() if n else 1
+    out = {}
+    for k in names:
+        if k in cols:
+            v = cols[k]
+            out[k] = v.tolist() if hasattr(v,'tolist') else list(v)
+        else:
+            out[k] = [params.get(k)]*n
+    return n,out
+
+def render_columns(t,n,cols,missing):
+    '''
+    Render :py:class:`Template` *t* *n* times, a column at a time. Return None if a
+    value contains ``$``, which only a sequential :py:func:`replace` renders the same way.
+    '''
+    out = [t.lits[0]]*n
+    for name,lit in zip(t.names,t.lits[1:]):
+        col = [v if v is None or type(v) is str else str(v) for v in cols[name]]
+        if any(v is not None and '$' in v for v in col):
+            return None
+        if None in col:
+            missing.add(name)
+            col = ['${}$'.format(name) if v is None else v for v in col]
+        out = [o+v+lit for o,v in zip(out,col)]
+    return out
+
+_LISTS = {}     # (path, converter) -> ((mtime, size), value), shared by all Ini objects
+
+def list_marker(s,dir_):
+    '''
+    Value of ``key = [<path>]``, an external list: ``'[<path>]'``, with a relative *path*
+    taken from the directory *dir_* of the file unless it has ``%..%`` references. The
+    vector must hold exactly one ``<path>`` item, without whitespace or ``<``/``>`` in
+    *path*; other vectors, e.g. ``[<a> <b>]``, are returned as they are.
+    '''
+    m = _pListFile.fullmatch(s)
+    if m is None:
+        return s
+    path = m.group(1)
+    if '%' not in path:
+        path = os.path.normpath(os.path.join(dir_,path))
+    return '[<{}>]'.format(path)
+
+def typed(v,conv):
+    '''
+    ``conv(v)``, or the items of the external list if *v* is ``'[<path>]'``.
+    '''
+    if v[:2]=='[<' and v[-2:]=='>]' and _pListFile.fullmatch(v,1,len(v)-1):
+        return list_file(v[2:-2],conv)
+    return conv(v)
+
+def list_file(path,conv):
+    '''
+    Items of an external list converted by one of the ``as_*`` functions, read on first use
+    and shared in the process until the file changes.
+
+    A ``.npy`` file is memory-mapped and served as it is by :py:func:`as_num_vec` if it holds
+    float64, by :py:func:`as_int_vec` if it holds integers, and by :py:func:`as_array` if it
+    holds that dtype. Other files hold one item per line, blank lines and lines starting
+    with ``#`` skipped.
+    '''
+    st = os.stat(path)
+    sig = (st.st_mtime_ns,st.st_size)
+    hit = _LISTS.get((path,conv))
+    if hit is not None and hit[0]==sig:
+        out = hit[1]
+        return list(out) if isinstance(out,list) else out
+    out = items = None
+    if path.endswith('.npy'):
+        a = np.load(path,mmap_mode='r')
+        dtype = getattr(conv,'dtype','str')
+        if conv is as_num_vec:
+            out = a if a.dtype==np.float64 else a.astype(np.float64)
+        elif conv is as_int_vec:
+            out = a if a.dtype.kind in 'iu' else a.astype(np.int64)
+        elif dtype != 'str':
+            out = a if a.dtype==dtype else a.astype(dtype)
+        else:
+            items = [str(x) for x in a.tolist()]
+    else:
+        with open(path) as f:
+            items = [l for l in (l.strip() for l in f) if l and l[0]!='#']
+    if out is None:
+        if conv is as_str_vec:
+            out = items
+        elif conv is as_bool_vec:
+            out = [str2bool(s) for s in items]
+        elif conv is as_num_vec:
+            out = np.array(items,dtype=np.float64)
+        elif conv is as_int_vec:
+            out = np.array([int(float(s)) for s in items],dtype=np.int64)
+        else:
+            out = conv(' '.join(items))
+    if isinstance(out,np.ndarray):
+        out.flags.writeable = False
+    _LISTS[(path,conv)] = (sig,out)
+    return list(out) if isinstance(out,list) else out
+
+def as_str(v):
+    return None if v.lower()=='none' else v
+
+def is_none(v):
+    return len(v)==4 and v.lower()=='none'
+
+def split_items(v):
+    return list(filter(None,v.split(' ')))
+
+def as_str_vec(v):
+    return None if is_none(v) else split_items(v)
+
+def as_bool(v):
+    return None if v.lower()=='none' else str2bool(v)
+
+def as_bool_vec(v):
+    return None if is_none(v) else [str2bool(s) for s in split_items(v)]
+
+def as_int(v):
+    return None if v.lower()=='none' else int(v)
+
+def as_int_vec(v):
+    if is_none(v):
+        return None
+    items = split_items(v)
+    a = np.array(items,dtype=np.float64)
+    if not len(a):
+        return np.array([])
+    if not (np.abs(a) < 2.0**63).all():
+    # 超出 int64 的值和 nan/inf 走原来的逐个 int(float(s))：同样的对象数组或同样的错误
+        return np.array([int(float(s)) for s in items])
+    return a.astype(np.int64)
+
+def as_num(v):
+    return None if v.lower()=='none' else float(v)
+
+def as_num_vec(v):
+    if is_none(v):
+        return None
+    v = v.strip('[').strip(']')
+    if ',' in v:
+        v = v.replace(',',' ')
+    return np.array(split_items(v),dtype=np.float64)
+
+class ArrayConv():
+    '''
+    Converter of a vector value into an array of one of the ``ARRAY_DTYPES``, see
+    :py:func:`as_array`.
+    '''
+    __slots__ = ['dtype']
+
+    def __init__(self,dtype:str):
+        self.dtype = dtype
+
+    def __call__(self,v):
+        if is_none(v):
+            return None
+        if self.dtype == 'str':
+            return StringArray(split_items(v))
+        if self.dtype == 'bool':
+            return np.array([str2bool(s) for s in split_items(v)],dtype=bool)
+        if self.dtype.startswith('int'):
+            return as_int_vec(v).astype(self.dtype,copy=False)
+        return as_num_vec(v).astype(self.dtype,copy=False)
+
+    def __repr__(self):
+        return 'as_array({!r})'.format(self.dtype)
+
+_ARRAY_CONV = {}    # dtype name -> ArrayConv
+
+@functools.lru_cache(maxsize=None)
+def as_array(dtype) -> ArrayConv:
+    '''
+    The one converter of *dtype* (see :py:func:`array_dtype`), so that typed results are
+    shared in the memo.
+    '''
+    name = array_dtype(dtype)
+    return _ARRAY_CONV.setdefault(name,ArrayConv(name))
+
+def array_dtype(dtype) -> str:
+    '''
+    Name in ``ARRAY_DTYPES`` of *dtype*, given as a name, a Python type or a numpy type.
+    '''
+    if dtype is str or dtype == 'str':
+        return 'str'
+    name = {bool:'bool',int:'int64',float:'float64'}.get(dtype) or np.dtype(dtype).name
+    if name not in ARRAY_DTYPES:
+        raise ValueError('Unsupported dtype {}, expected one of {}.'.format(dtype,ARRAY_DTYPES))
+    return name
+
+CONVERTERS = { 'string'    : as_str,       str     : as_str,
+               'stringvec' : as_str_vec,
+               'bool'      : as_bool,      bool    : as_bool,
+               'boolvec'   : as_bool_vec,
+               'int'       : as_int,       int     : as_int,
+               'intvec'    : as_int_vec,
+               'num'       : as_num,       float   : as_num,
+               'float'     : as_num,
+               'numvec'    : as_num_vec,
+               'floatvec'  : as_num_vec,
+              }
+DEFAULT_CAST = { as_int_vec : lambda v: np.array(v).astype(int),
+                 as_num_vec : lambda v: np.array(v).astype(float),
+                }
+
+def to_record(values:dict):
+    '''
+    Pack ``{name: value}`` into a numpy structured record. Numbers and booleans keep
+    their numpy types, everything else is stored as object.
+    '''
+    dtype = []
+    for k,v in values.items():
+        if isinstance(v,(bool,np.bool_)):
+            dtype.append((k,np.bool_))
+        elif isinstance(v,(int,np.integer)):
+            dtype.append((k,np.int64))
+        elif isinstance(v,(float,np.floating)):
+            dtype.append((k,np.float64))
+        else:
+            dtype.append((k,object))
+    rec = np.empty(1,dtype=dtype)
+    for k,v in values.items():
+        rec[k][0] = v
+    return rec[0]
+
 def str2bool(s):
     s = s.lower()
     if s in ['true','t','1']:
@@ -676,3 +3437,172 @@ def str2bool(s):
     else:
         raise Exception('Can\'t convert [{}] to a boolean value.'.format(s))
 
+QUERY_METHODS = { 'exists','find','findStringVec','findBool','findBoolVec','findInt','findIntVec','findNum',
+                  'findNumVec','get','getStringVec','getBool','getBoolVec','getInt','getIntVec','getNum',
+                  'getNumVec' }
+
+def run_queries(o,queries:list) -> list:
+    '''
+    Answers of *queries* ``[[method, field, *args]]`` on *o*, as JSON values.
+    '''
+    out = []
+    for q in queries:
+        if q[0] not in QUERY_METHODS:
+            raise ValueError('Unknown query {}.'.format(q[0]))
+        v = getattr(o,q[0])(*q[1:])
+        out.append(v.tolist() if hasattr(v,'tolist') else v)
+    return out
+
+def default_socket() -> str:
+    '''
+    Socket of the query daemon: ``$INI_SOCKET``, else ``ini-<uid>.sock`` in
+    ``$XDG_RUNTIME_DIR``, else ``ini.sock`` in the directory ``/tmp/ini-<uid>``, see
+    :py:func:`private_dir`.
+    '''
+    path = os.environ.get('INI_SOCKET')
+    if path:
+        return path
+    run = os.environ.get('XDG_RUNTIME_DIR')
+    if run:
+        return os.path.join(run,'ini-{}.sock'.format(os.getuid()))
+    return os.path.join(private_dir('/tmp/ini-{}'.format(os.getuid())),'ini.sock')
+
+def private_dir(path:str) -> str:
+    '''
+    *path*, created with mode 0700 if needed. Raise PermissionError unless it is a directory
+    of this user closed to the others, so that no one else can put a socket in it.
+    '''
+    try:
+        os.mkdir(path,0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid!=os.getuid() or st.st_mode&0o077:
+        raise PermissionError('{} is not a private directory of this user ( uid: {} ).'.format(path,os.getuid()))
+    return path
+
+def check_socket(path:str):
+    '''
+    Raise PermissionError unless the socket *path* belongs to this user: the client sends
+    its environment and evaluates the answers, so it must not talk to a daemon of someone
+    else. FileNotFoundError if there is no socket.
+    '''
+    owner = os.stat(path).st_uid
+    if owner!=os.getuid():
+        raise PermissionError('Socket {} belongs to uid {}, not to this user ( uid: {} ).'.format(path,owner,os.getuid()))
+
+_QUERY_ERRORS = { e.__name__:e for e in [INIFormatError,INIRefError,INICommandError,KeyError,ValueError,
+                                         TypeError,OSError] }
+
+def query(fini:str,queries:list,path:str=None,timeout:float=None) -> list:
+    '''
+    Answers of *queries* ``[[method, field, *args]]`` on *fini*, from the daemon of
+    :py:class:`IniServer` at *path*, in the environment and working directory of this
+    process. The same as ``[getattr(Ini(fini), m)(*args) for m, *args in queries]``, with
+    arrays as lists.
+
+    Raises
+    ------
+    ConnectionError, FileNotFoundError
+        If no daemon listens on *path*.
+    PermissionError
+        If *path* belongs to another user, see :py:func:`check_socket`.
+    '''
+    path = default_socket() if path is None else path
+    check_socket(path)
+    req = {'fini':os.path.abspath(fini),'cwd':os.getcwd(),'env':dict(os.environ),'queries':queries}
+    with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(req).encode()+b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('No answer from {}.'.format(path))
+    reply = json.loads(line)
+    if 'error' in reply:
+        raise _QUERY_ERRORS.get(reply['type'],INIFormatError)(reply['error'])
+    return reply['values']
+
+def shell_assign(name:str,v) -> str:
+    '''
+    ``NAME='value'``, or ``NAME=('a' 'b')`` for lists, with *name* made a valid variable name
+    (``~`` as ``__``, like the environment variables read by ``|=``).
+    '''
+    name = re.sub(r'\W','_',name.upper().replace('~','__'))
+    if isinstance(v,list):
+        return '{}=({})'.format(name,' '.join(shlex.quote(str(x)) for x in v))
+    return '{}={}'.format(name,shlex.quote(str(v)))
+
+def main(argv:list=None) -> int:
+    '''
+    Command line, see ``python -m ini -h``. With the compiled module, which ``-m`` cannot
+    run, use ``python -c 'import sys,ini; sys.exit(ini.main())'``.
+    '''
+    parser = argparse.ArgumentParser(prog='python -m ini',description='Query ini configuration files.')
+    sub = parser.add_subparsers(dest='command',required=True)
+    p = sub.add_parser('get',help='print fields as shell assignments',
+                       description='Print fields as shell assignments, for eval "$(python -m ini get ...)". '
+                                   'Fields ending with [] are printed as arrays. The daemon is used if it '
+                                   'listens, otherwise the file is parsed here.')
+    p.add_argument('fini')
+    p.add_argument('fields',nargs='+')
+    p.add_argument('--prefix',default='',help='prefix of the variable names')
+    p.add_argument('--json',action='store_true',help='print one JSON object instead')
+    p.add_argument('--socket',help='socket of the daemon (default: $INI_SOCKET, else in $XDG_RUNTIME_DIR or /tmp/ini-<uid>/)')
+    p.add_argument('--no-daemon',action='store_true',help='always parse here')
+    p = sub.add_parser('serve',help='run the query daemon in the foreground')
+    p.add_argument('--socket',help='socket path (default: $INI_SOCKET, else in $XDG_RUNTIME_DIR or /tmp/ini-<uid>/)')
+    p.add_argument('--max-configs',type=int,default=256,help='parsed files kept in memory')
+    p = sub.add_parser('stop',help='stop the query daemon')
+    p.add_argument('--socket',help='socket path')
+    p = sub.add_parser('diff',help='print the changed keys, exit status 1 if any',
+                       description='Compare fini with other, or with its files on disk if other is not given.')
+    p.add_argument('fini')
+    p.add_argument('other',nargs='?')
+    p.add_argument('--env',action='store_true',help='also compare the keys only in the environment')
+    p.add_argument('--builtin',action='store_true',help='also compare PATH_FINI, CUR_DIR, TODAY and DATE')
+    args = parser.parse_args(argv)
+    try:
+        if args.command == 'serve':
+            IniServer(args.socket,args.max_configs).serve_forever()
+        elif args.command == 'stop':
+            path = args.socket or default_socket()
+            check_socket(path)
+            with socket.socket(socket.AF_UNIX,socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+                sock.sendall(b'{"stop": true}\n')
+                sock.recv(1024)
+        elif args.command == 'diff':
+            with contextlib.redirect_stdout(sys.stderr):
+                o = Ini(args.fini)
+                d = o.diff(None if args.other is None else Ini(args.other),args.env,args.builtin)
+            if d:
+                print(d)
+            return 1 if d else 0
+        else:
+            names = [f[:-2] if f.endswith('[]') else f for f in args.fields]
+            queries = [['findStringVec',n] if f.endswith('[]') else ['find',n] for f,n in zip(args.fields,names)]
+            values = None
+            if not args.no_daemon:
+                try:
+                    values = query(args.fini,queries,args.socket)
+                except (ConnectionError,FileNotFoundError):
+                    pass
+                except PermissionError as e:
+                    print('Warning: daemon not used: {}'.format(e),file=sys.stderr)
+            if values is None:
+                # 警告打到 stderr，stdout 只留给 eval
+                with contextlib.redirect_stdout(sys.stderr):
+                    values = run_queries(Ini(args.fini),queries)
+            if args.json:
+                print(json.dumps(dict(zip(names,values))))
+            else:
+                print('\n'.join(shell_assign(args.prefix+n,v) for n,v in zip(names,values)))
+    except (INIFormatError,INICommandError,KeyError,ValueError,OSError) as e:
+        print('ini: {}'.format(e),file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())